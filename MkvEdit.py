@@ -2,365 +2,2191 @@
 
 
 from collections import namedtuple
+from contextlib import closing, contextmanager
+from csv import reader
+from ctypes import byref, c_char_p, c_int64, c_size_t, c_ssize_t, c_uint, CDLL, create_string_buffer, get_errno
+from errno import EBADF, EINVAL, ENOSYS, ENOTSUP, EOPNOTSUPP, ESPIPE, ESRCH, EXDEV
+from fcntl import ioctl
+from functools import reduce
 from inspect import getmembers, isfunction
-from os import SEEK_CUR
-from sys import argv, modules
+from io import BytesIO
+from json import dumps, loads
+from mmap import mmap, ACCESS_READ
+from multiprocessing import cpu_count, Pool
+from multiprocessing.pool import ThreadPool
+from multiprocessing.queues import SimpleQueue
+from os import close, dup, fdopen, fstat, fstatvfs, fsync, getpid, kill, lseek, rename, remove, sep, stat, strerror, times, walk, SEEK_CUR, SEEK_SET
+from os.path import abspath, dirname, exists, isdir, isfile, join, samefile, splitext
+from resource import getrusage, RUSAGE_SELF
+from shutil import copymode
+from sqlite3 import connect
+from stat import S_ISREG
+from struct import pack, Struct
+from sys import argv, modules, stderr, stdin, stdout
+from tempfile import mkstemp
+from time import time
+from zlib import crc32
 
+try:
+    from os import copy_file_range as __os_copy_file_range
+except ImportError:
+    __os_copy_file_range = None
 
-from ebml.core import encode_element_id, encode_element_size, encode_unicode_string, encode_unsigned_integer, MAXIMUM_ELEMENT_SIZE_LENGTH
-from ebml.schema.matroska import AttachmentsElement, AttachedFileElement, DateUTCElement, FileNameElement, FileUIDElement, InfoElement, MatroskaDocument, MuxingAppElement, SegmentElement, TracksElement, TrackEntryElement, TrackNumberElement, TrackUIDElement, WritingAppElement
+try:
+    from os import sendfile as __os_sendfile
+except ImportError:
+    __os_sendfile = None
 
+try:
+    from os import pread as __os_pread, pwrite as __os_pwrite
+except ImportError:
+    __os_pread = __os_pwrite = None
 
-def remove_dateutc(input_filename, output_filename):
+try:
+    from os import posix_fadvise as __os_posix_fadvise
+except ImportError:
+    __os_posix_fadvise = None
 
-    with open(input_filename, "rb") as input_file:
+try:
+    from hashlib import blake2b as __verification_hash
+except ImportError:
+    from hashlib import sha1 as __verification_hash
 
-        input_matroska_document = MatroskaDocument(input_file)
 
-        # retrieve element metadata
-        segment_element_metadata = __find_element_metadata(input_matroska_document.roots, SegmentElement, 0)
+from ebml.core import decode_vint_length, encode_element_id, encode_element_size, encode_unicode_string, encode_unsigned_integer, maximum_element_size_for_length, read_element_id, read_element_size, read_unicode_string, read_unsigned_integer, MAXIMUM_ELEMENT_SIZE_LENGTH
+from ebml.schema.matroska import AttachmentsElement, AttachedFileElement, ClusterElement, CRC32Element, DateUTCElement, FileNameElement, FileUIDElement, InfoElement, MuxingAppElement, SeekHeaderElement, SeekIDElement, SeekPointElement, SeekPositionElement, SegmentElement, TracksElement, TrackEntryElement, TrackNumberElement, TrackUIDElement, VoidElement, WritingAppElement
 
-        info_element_metadata = __find_element_metadata(segment_element_metadata.element.value, InfoElement, segment_element_metadata.offset + segment_element_metadata.element.head_size)
 
-        dateutc_element_metadata = __find_element_metadata(info_element_metadata.element.value, DateUTCElement, info_element_metadata.offset + info_element_metadata.element.head_size)
+def remove_dateutc(input_filename, output_filename, **options):
 
-        # calculate edited element sizes
-        new_info_element_body_size = info_element_metadata.element.body_size - dateutc_element_metadata.element.stream.size
-        new_info_element_head_size = len(encode_element_size(new_info_element_body_size)) + 4	# 4 byte element id (0x1549A966)
+    return __edit_file(input_filename, output_filename, [(__remove_dateutc_edit, ())], options)
 
-        new_segment_element_body_size = segment_element_metadata.element.body_size + new_info_element_head_size + new_info_element_body_size - info_element_metadata.element.stream.size
-        new_segment_element_head_size = len(encode_element_size(new_segment_element_body_size)) + 4	# 4 byte element id (0x18538067)
 
-        # write out the new file
-        with open(output_filename, "wb") as output_file:
+def change_muxingapp(input_filename, output_filename, new_muxingapp, **options):
 
-            # write the pre-segment header block
-            input_file.seek(0)
-            __buffered_file_copy(input_file, output_file, segment_element_metadata.offset)
+    return __edit_file(input_filename, output_filename, [(__change_muxingapp_edit, (new_muxingapp,))], options)
 
-            # write the segment header
-            output_file.write(encode_element_id(SegmentElement.id))
-            output_file.write(encode_element_size(new_segment_element_body_size, MAXIMUM_ELEMENT_SIZE_LENGTH))
 
-            # write the post-segment header block / pre-info header block
-            input_file.seek(segment_element_metadata.element.head_size, SEEK_CUR)
-            __buffered_file_copy(input_file, output_file, info_element_metadata.offset - (segment_element_metadata.offset + segment_element_metadata.element.head_size))
+def change_writingapp(input_filename, output_filename, new_writingapp, **options):
 
-            # write the info header
-            output_file.write(encode_element_id(InfoElement.id))
-            output_file.write(encode_element_size(new_info_element_body_size))
+    return __edit_file(input_filename, output_filename, [(__change_writingapp_edit, (new_writingapp,))], options)
 
-            # write the post-info header block / pre-dateutc header block
-            input_file.seek(info_element_metadata.element.head_size, SEEK_CUR)
-            __buffered_file_copy(input_file, output_file, dateutc_element_metadata.offset - (info_element_metadata.offset + info_element_metadata.element.head_size))
 
-            # write the post-dateutc block
-            input_file.seek(dateutc_element_metadata.element.stream.size, SEEK_CUR)
-            __buffered_file_copy(input_file, output_file)
+def change_trackuid(input_filename, output_filename, track_number, new_trackuid, **options):
 
-            return       
+    return __edit_file(input_filename, output_filename, [(__change_trackuid_edit, (track_number, new_trackuid))], options)
 
 
-def change_muxingapp(input_filename, output_filename, new_muxingapp):
+def change_attachment_fileuid(input_filename, output_filename, attachment_filename, new_fileuid, **options):
 
-    with open(input_filename, "rb") as input_file:
+    return __edit_file(input_filename, output_filename, [(__change_attachment_fileuid_edit, (attachment_filename, new_fileuid))], options)
 
-        input_matroska_document = MatroskaDocument(input_file)
 
-        # retrieve element metadata
-        segment_element_metadata = __find_element_metadata(input_matroska_document.roots, SegmentElement, 0)
+def apply_edits(input_filename, output_filename, *edits, **options):
 
-        info_element_metadata = __find_element_metadata(segment_element_metadata.element.value, InfoElement, segment_element_metadata.offset + segment_element_metadata.element.head_size)
+    # edits are the names of the other commands, each followed by its arguments less the file names, e.g.
+    #   apply_edits in.mkv out.mkv remove_dateutc change_muxingapp mkvedit change_trackuid 1 1234
+    # or, from python, a sequence holding the name and arguments of each edit
+    edit_functions = []
+    edit_tokens = list(edits)
 
-        muxingapp_element_metadata = __find_element_metadata(info_element_metadata.element.value, MuxingAppElement, info_element_metadata.offset + info_element_metadata.element.head_size)
+    while edit_tokens:
+        edit_token = edit_tokens.pop(0)
 
-        # calculate edited element sizes
-        new_muxingapp_element_body_size = len(encode_unicode_string(new_muxingapp))
-        new_muxingapp_element_head_size = len(encode_element_size(new_muxingapp_element_body_size)) + 2	# 2 byte element id (0x4D80)
+        if isinstance(edit_token, (list, tuple)):
+            edit_name, edit_arguments = edit_token[0], tuple(edit_token[1:])
 
-        new_info_element_body_size = info_element_metadata.element.body_size + new_muxingapp_element_head_size + new_muxingapp_element_body_size - muxingapp_element_metadata.element.stream.size
-        new_info_element_head_size = len(encode_element_size(new_info_element_body_size)) + 4	# 4 byte element id (0x1549A966)
+        else:
+            edit_name = edit_token
+            edit_arguments = None
+
+        if edit_name not in __EDIT_FUNCTIONS:
+            raise Exception("Cannot find edit command %s." % edit_name)
+
+        edit_function = __EDIT_FUNCTIONS[edit_name]
+        edit_argument_count = edit_function.__code__.co_argcount - 1	# less the element reader
+
+        if edit_arguments is None:
+            edit_arguments = tuple(edit_tokens[:edit_argument_count])
+            del edit_tokens[:edit_argument_count]
+
+        if len(edit_arguments) != edit_argument_count:
+            raise Exception("Edit command %s expects %d argument(s)." % (edit_name, edit_argument_count))
+
+        edit_functions.append((edit_function, edit_arguments))
+
+    if not edit_functions:
+        raise Exception("Command apply_edits expects at least one edit.")
+
+    return __edit_file(input_filename, output_filename, edit_functions, options)
+
+
+def run_jobs(jobs_filename = "-"):
+
+    # each line of the jobs file (or stdin) is a json object naming a command, its arguments and any options, e.g.
+    #   {"id": "42", "command": "change_trackuid", "arguments": ["in.mkv", "out.mkv", "1", "1234"]}
+    # and each produces a single json result line on stdout, so one process can serve any number of edits
+    job_count = 0
+    failed_job_count = 0
+
+    jobs_file = stdin if jobs_filename == "-" else open(jobs_filename, "r")
+
+    try:
+        # read line by line rather than with the file iterator, whose read ahead would stall a pipe
+        for line in iter(jobs_file.readline, ""):
+            if not line.strip():
+                continue
+
+            job_count += 1
+            job_result = __run_job(__parse_job(line, job_count))
+
+            if job_result["status"] != "ok":
+                failed_job_count += 1
+
+            stdout.write(dumps(job_result, sort_keys = True) + "\n")
+            stdout.flush()
+
+    finally:
+        if jobs_file is not stdin:
+            jobs_file.close()
+
+    return {"jobs": job_count, "failed": failed_job_count}
+
+
+def run_batch(source, *edit, **options):
+
+    # the source is either a directory tree whose matroska files all receive the same edit in place, e.g.
+    #   run_batch /media/library change_trackuid 1 1234 --workers=8 --workers-per-device=2
+    # or a manifest of jobs, as csv rows of a command and its arguments or as the json lines read by run_jobs
+    workers = int(options.pop("workers", cpu_count()))
+    workers_per_device = int(options.pop("workers_per_device", 2))
+    journal_filename = options.pop("journal", source.rstrip(sep) + (".plan.journal" if options.get("plan") else ".journal"))
+
+    # any other options (e.g. --index) are passed on to each job's command
+    jobs = __read_batch_jobs(source, edit)
+    for job in jobs:
+        job["options"] = dict(options, **job.get("options", {}))
+
+    # resume an interrupted run by skipping the jobs its journal records as done, with the same edit
+    completed_job_keys = __read_completed_job_keys(journal_filename)
+    pending_jobs = [job for job in jobs if __job_key(job) not in completed_job_keys]
+
+    # queue the jobs by the device holding their input, so that no one disk serves more than its share of the workers
+    device_jobs = {}
+    device_running_counts = {}
+    job_sizes = {}
+
+    for job in pending_jobs:
+        device, job_sizes[job["id"]] = __job_device_and_size(job)
+        device_jobs.setdefault(device, []).append(job)
+        device_running_counts[device] = 0
+
+    batch_result = {"jobs": len(jobs), "skipped": len(jobs) - len(pending_jobs), "failed": 0}
+    finished_job_count = 0
+    finished_bytes = 0
+    start_time = time()
+
+    # each worker reports the jobs it starts, so that a job whose worker dies (e.g. killed for want of memory) can be failed rather than awaited forever
+    job_start_queue = SimpleQueue()
+    job_worker_ids = {}
+
+    pool = Pool(workers, __set_job_start_queue, (job_start_queue,))
+    running_jobs = []
+    job_number = 0
+    lost_job_count = 0
+
+    try:
+        with open(journal_filename, "a") as journal_file:
+            while device_jobs or running_jobs:
+
+                # start jobs on each device with a free share of the workers...
+                for device in list(device_jobs):
+                    while device_jobs[device] and len(running_jobs) < workers and device_running_counts[device] < workers_per_device:
+                        job = device_jobs[device].pop(0)
+                        job_number += 1
+                        running_jobs.append((device, job, pool.apply_async(__run_job, (job, job_number)), job_number))
+                        device_running_counts[device] += 1
+
+                    if not device_jobs[device]:
+                        del device_jobs[device]
+
+                # ...then wait for any of them to finish, or to be lost with their worker
+                while not job_start_queue.empty():
+                    started_job_number, worker_id = job_start_queue.get()
+                    job_worker_ids[started_job_number] = worker_id
+
+                finished_jobs = [running_job for running_job in running_jobs if running_job[2].ready() or __job_worker_exited(job_worker_ids.get(running_job[3]), running_job[2])]
+                if not finished_jobs:
+                    running_jobs[0][2].wait(0.1)
+                    continue
+
+                for running_job in finished_jobs:
+                    device, job, async_result, finished_job_number = running_job
+                    running_jobs.remove(running_job)
+                    device_running_counts[device] -= 1
+
+                    if async_result.ready():
+                        job_result = async_result.get()
+
+                    else:
+                        lost_job_count += 1
+                        job_result = {"id": job["id"], "status": "error", "error": "Exception: The worker running the job exited before finishing it.", "command": job.get("command"), "arguments": job.get("arguments", [])}
+                    finished_job_count += 1
+                    finished_bytes += job_sizes[job["id"]]
+
+                    if job_result["status"] != "ok":
+                        batch_result["failed"] += 1
+
+                    # journal each result as it arrives so an interrupted run loses nothing that finished
+                    journal_file.write(dumps(job_result, sort_keys = True) + "\n")
+                    journal_file.flush()
+
+                    stdout.write(dumps(job_result, sort_keys = True) + "\n")
+                    stdout.flush()
+
+                    # report progress and throughput, and any failure, without stopping the batch
+                    elapsed_time = max(time() - start_time, 0.001)
+                    stderr.write("[{0}/{1}] {2} {3}{4} ({5:.1f} files/s, {6:.1f} MB/s)\n".format(finished_job_count, len(pending_jobs), job_result["status"], job_result["id"], ": " + job_result["error"] if "error" in job_result else "", finished_job_count / elapsed_time, finished_bytes / elapsed_time / (1024 * 1024)))
+
+    except KeyboardInterrupt:
+        pool.terminate()
+        raise
+
+    # a pool which lost a job to a dead worker waits on it forever when closed, though every job has been accounted for
+    if lost_job_count:
+        pool.terminate()
+
+    else:
+        pool.close()
+
+    pool.join()
+
+    return batch_result
+
+
+def __read_batch_jobs(source, edit):
+
+    jobs = []
+
+    if isdir(source):
+        if not edit:
+            raise Exception("Command run_batch expects an edit command to apply to the files of directory %s." % source)
+
+        # edit every matroska file in the tree in place
+        for directory_path, directory_names, filenames in walk(source):
+            directory_names.sort()
+
+            for filename in sorted(filenames):
+                if splitext(filename)[1].lower() in (".mkv", ".mka", ".mks", ".mk3d"):
+                    file_path = join(directory_path, filename)
+                    jobs.append({"id": file_path, "command": edit[0], "arguments": [file_path, file_path] + list(edit[1:])})
+
+        return jobs
+
+    if edit:
+        raise Exception("Command run_batch takes its edits from manifest %s." % source)
+
+    with open(source, "r") as manifest_file:
+        if splitext(source)[1].lower() == ".csv":
+            for row_number, row in enumerate(reader(manifest_file), 1):
+                if row:
+                    jobs.append({"id": row_number, "command": row[0], "arguments": row[1:]})
+
+        else:
+            for line_number, line in enumerate(manifest_file, 1):
+                if line.strip():
+                    jobs.append(__parse_job(line, line_number))
+
+    return jobs
+
+
+def __read_completed_job_keys(journal_filename):
+
+    completed_job_keys = set()
+
+    if exists(journal_filename):
+        with open(journal_filename, "r") as journal_file:
+            for line in journal_file:
+                # the last line may be torn if the run was killed while writing it
+                try:
+                    job_result = loads(line)
+
+                except ValueError:
+                    continue
+
+                if job_result.get("status") == "ok":
+                    completed_job_keys.add(__job_key(job_result))
+
+    return completed_job_keys
+
+
+def __job_key(job):
+
+    # a file given a different edit, or the same edit with different arguments, is a different job
+    return dumps([job["id"], job.get("command"), job.get("arguments", [])], sort_keys = True)
+
+
+def __job_device_and_size(job):
+
+    # jobs whose input cannot be found share a device, and fail when they run
+    try:
+        file_status = stat(job["arguments"][0])
+        return file_status.st_dev, file_status.st_size
+
+    except (EnvironmentError, IndexError, KeyError):
+        return None, 0
+
+
+def __parse_job(line, line_number):
+
+    # a malformed line still becomes a job, which fails with the parsing error
+    try:
+        job = loads(line)
+
+    except ValueError as error:
+        return {"id": line_number, "error": "{0}: {1}".format(type(error).__name__, error)}
+
+    # as does a line holding json other than an object, or options other than an object
+    if not isinstance(job, dict):
+        return {"id": line_number, "error": "ValueError: A job must be a json object."}
+
+    if not isinstance(job.get("options", {}), dict):
+        return {"id": job.get("id", line_number), "error": "ValueError: The options of a job must be a json object."}
+
+    job.setdefault("id", line_number)
+    return job
+
+
+def __set_job_start_queue(job_start_queue):
+
+    global __job_start_queue
+    __job_start_queue = job_start_queue
+
+
+def __job_worker_exited(worker_id, async_result):
+
+    # a job not yet started by any worker cannot have lost it
+    if worker_id is None:
+        return False
+
+    try:
+        kill(worker_id, 0)
+        return False
+
+    except OSError as error:
+        if error.errno != ESRCH:
+            raise
+
+    # the worker may have sent its result just before exiting, so give it a moment to arrive
+    async_result.wait(1)
+    return not async_result.ready()
+
+
+__job_start_queue = None
+
+
+def __run_job(job, job_number = None):
+
+    job_result = {"id": job["id"], "status": "ok"}
+    start_time = time()
+
+    if __job_start_queue is not None:
+        __job_start_queue.put((job_number, getpid()))
+
+    # a job which could not be parsed fails with its parsing error as it stands
+    if "error" in job:
+        job_result["status"] = "error"
+        job_result["error"] = job["error"]
+        job_result["elapsed"] = 0.0
+        return job_result
+
+    try:
+        job_result["command"] = job["command"]
+        job_result["arguments"] = job.get("arguments", [])
+
+        # jobs are limited to the edit commands, rather than any function this script holds or imports
+        if job["command"] not in __JOB_COMMANDS:
+            raise Exception("Cannot find command %s." % job["command"])
+
+        # standard input carries the jobs and standard output their results, so neither can stand in for a job's input or output file
+        if "-" in job.get("arguments", [])[:2]:
+            raise Exception("Jobs cannot read from standard input or write to standard output.")
+
+        result = __find_command(job["command"])(*job.get("arguments", []), **dict((str(key), value) for key, value in job.get("options", {}).items()))
+        if result is not None:
+            job_result["result"] = result
+
+    except Exception as error:
+        job_result["status"] = "error"
+        job_result["error"] = "{0}: {1}".format(type(error).__name__, error)
+
+    job_result["elapsed"] = time() - start_time
+    return job_result
+
+
+def __find_command(command_name):
+
+    # does this script contain the requested command?
+    command_tuples = getmembers(modules[__name__], lambda member: isfunction(member) and member.__name__ == command_name)
+
+    if len(command_tuples) == 0:
+        raise Exception("Cannot find command %s." % command_name)
+
+    return command_tuples[0][1]
+
+
+def __parse_option(argument):
+
+    # --some-option=value becomes some_option="value" and a bare --some-option becomes some_option=True
+    name, separator, value = argument[2:].partition("=")
+    return name.replace("-", "_"), value if separator else True
+
+
+def __remove_dateutc_edit(element_reader):
+
+    # retrieve element metadata
+    segment_element_metadata = __find_segment_element_metadata(element_reader)
+
+    info_element_metadata = __find_top_level_element_metadata(element_reader, segment_element_metadata, InfoElement)
+
+    dateutc_element_metadata = __find_element_metadata(element_reader, info_element_metadata, DateUTCElement)
+
+    # remove the dateutc element
+    return ElementEdit([segment_element_metadata, info_element_metadata, dateutc_element_metadata], None)
+
+
+def __change_muxingapp_edit(element_reader, new_muxingapp):
+
+    # retrieve element metadata
+    segment_element_metadata = __find_segment_element_metadata(element_reader)
+
+    info_element_metadata = __find_top_level_element_metadata(element_reader, segment_element_metadata, InfoElement)
+
+    muxingapp_element_metadata = __find_element_metadata(element_reader, info_element_metadata, MuxingAppElement)
+
+    # replace the muxingapp
+    return ElementEdit([segment_element_metadata, info_element_metadata, muxingapp_element_metadata], encode_unicode_string(new_muxingapp))
+
+
+def __change_writingapp_edit(element_reader, new_writingapp):
+
+    # retrieve element metadata
+    segment_element_metadata = __find_segment_element_metadata(element_reader)
+
+    info_element_metadata = __find_top_level_element_metadata(element_reader, segment_element_metadata, InfoElement)
+
+    writingapp_element_metadata = __find_element_metadata(element_reader, info_element_metadata, WritingAppElement)
+
+    # replace the writingapp
+    return ElementEdit([segment_element_metadata, info_element_metadata, writingapp_element_metadata], encode_unicode_string(new_writingapp))
+
+
+def __change_trackuid_edit(element_reader, track_number, new_trackuid):
+
+    # retrieve element metadata
+    segment_element_metadata = __find_segment_element_metadata(element_reader)
+
+    tracks_element_metadata = __find_top_level_element_metadata(element_reader, segment_element_metadata, TracksElement)
+
+    trackentry_element_metadata = __find_keyed_element_metadata(element_reader, tracks_element_metadata, TrackEntryElement, TrackNumberElement, read_unsigned_integer, long(track_number))
+
+    trackuid_element_metadata = __find_element_metadata(element_reader, trackentry_element_metadata, TrackUIDElement)
+
+    # replace the trackuid
+    return ElementEdit([segment_element_metadata, tracks_element_metadata, trackentry_element_metadata, trackuid_element_metadata], encode_unsigned_integer(long(new_trackuid)))
+
+
+def __change_attachment_fileuid_edit(element_reader, attachment_filename, new_fileuid):
+
+    # retrieve element metadata
+    segment_element_metadata = __find_segment_element_metadata(element_reader)
+
+    attachments_element_metadata = __find_top_level_element_metadata(element_reader, segment_element_metadata, AttachmentsElement)
+
+    attachedfile_element_metadata = __find_keyed_element_metadata(element_reader, attachments_element_metadata, AttachedFileElement, FileNameElement, read_unicode_string, attachment_filename)
+
+    fileuid_element_metadata = __find_element_metadata(element_reader, attachedfile_element_metadata, FileUIDElement)
+
+    # replace the fileuid
+    return ElementEdit([segment_element_metadata, attachments_element_metadata, attachedfile_element_metadata, fileuid_element_metadata], encode_unsigned_integer(long(new_fileuid)))
+
+
+__EDIT_FUNCTIONS = {
+    "remove_dateutc": __remove_dateutc_edit,
+    "change_muxingapp": __change_muxingapp_edit,
+    "change_writingapp": __change_writingapp_edit,
+    "change_trackuid": __change_trackuid_edit,
+    "change_attachment_fileuid": __change_attachment_fileuid_edit,
+}
+
+
+__JOB_COMMANDS = frozenset(list(__EDIT_FUNCTIONS) + ["apply_edits"])
+
+
+def __edit_file(input_filename, output_filename, edit_functions, options):
+
+    # an element index (--index for sidecar files, --index=path for a shared sqlite database) saves rescanning files edited repeatedly
+    element_index_location = options.pop("index", None)
+    element_index_size = int(options.pop("index_size", 100000))
+
+    # --stats reports where the time went, --stats=json does so as a single json line and a stats_callback receives the same figures
+    stats_format = options.pop("stats", None)
+    stats_callback = options.pop("stats_callback", None)
+
+    # --verify checks the edited elements and their checksums by parsing the output again, reading little more than element heads, while
+    # --verify=full also hashes the unchanged bytes on their way through python and reads the whole output back, a second pass over the file
+    verify = options.pop("verify", False)
+    if verify not in (False, True, "full"):
+        raise Exception("Option --verify takes no value or full.")
+
+    # --plan only reports what the edit would do, estimating its time from --copy-rate in MB/s
+    plan = bool(options.pop("plan", False))
+    copy_rate = float(options.pop("copy_rate", 200))
+
+    # --resumable rewrites through a checkpointed partial file, syncing every --checkpoint-size and writing back every --writeback-size MB
+    resumable_copy = None
+    if options.pop("resumable", False):
+        resumable_copy = ResumableCopy(int(float(options.pop("checkpoint_size", 1024)) * 1024 * 1024), int(float(options.pop("writeback_size", 16)) * 1024 * 1024))
+
+    # --copy-threads copies the unchanged data in --copy-chunk-size MB chunks from that many threads at once, for storage that only reaches its bandwidth with many requests in flight
+    copy_threads = int(options.pop("copy_threads", 0))
+    copy_chunk_size = int(float(options.pop("copy_chunk_size", 8)) * 1024 * 1024)
+    parallel_copy = ParallelCopy(copy_threads, copy_chunk_size) if copy_threads > 0 else None
+
+    if parallel_copy is not None and resumable_copy is not None:
+        raise Exception("Cannot copy in parallel when the copy is resumable.")
+
+    if verify == "full" and resumable_copy is not None:
+        raise Exception("Cannot fully verify a resumable copy, which may not copy every unchanged byte in one run.")
+
+    if options:
+        raise Exception("Edit commands do not take option(s) %s." % ", ".join(sorted(options)))
+
+    profile = EditProfile()
+
+    if plan:
+        result = __plan_edit_file(input_filename, output_filename, edit_functions, element_index_location, copy_rate, profile)
+
+    else:
+        result = __edit_open_file(input_filename, output_filename, edit_functions, element_index_location, verify, resumable_copy, parallel_copy, profile)
+
+    # record the layout of the file just written so that the next edit of it can seek straight to its elements
+    if element_index_location is not None and not plan and output_filename != "-" and isfile(output_filename):
+        with profile.phase("index"):
+            __save_element_index(element_index_location, output_filename, element_index_size)
+
+    if stats_format is not None or stats_callback is not None:
+        stats = profile.report(result)
+
+        if stats_callback is not None:
+            stats_callback(stats)
+
+        if stats_format == "json":
+            stderr.write(dumps(stats, sort_keys = True) + "\n")
+
+        elif stats_format is not None:
+            __write_stats(stats)
+
+    return result
+
+
+def __edit_open_file(input_filename, output_filename, edit_functions, element_index_location, verify, resumable_copy, parallel_copy, profile):
+
+    # editing a file onto itself patches it in place wherever padding allows
+    in_place = input_filename != "-" and exists(output_filename) and samefile(input_filename, output_filename)
+
+    # a resumable copy needs an input that stays as it is between runs, and that can be read from any offset
+    if resumable_copy is not None and in_place:
+        raise Exception("Cannot resume an edit of a file in place.")
+
+    with __open_file(input_filename, "r+b" if in_place else "rb") as opened_input_file:
+        input_file = ProfiledFile(opened_input_file, profile)
+
+        # a pipe can only be read once, in order, so only its head is buffered and edited as the rest streams through
+        if not S_ISREG(fstat(input_file.fileno()).st_mode):
+            if resumable_copy is not None:
+                raise Exception("Cannot resume an edit of an input which is not a regular file.")
+
+            with __open_file(output_filename, "wb") as output_file:
+                return __stream_file(input_file, ProfiledFile(output_file, profile), edit_functions, verify, profile)
+
+        with profile.phase("index"):
+            element_index = __load_element_index(element_index_location, input_filename, input_file)
+
+        # the element heads are decoded straight from a map of the file, so locating elements makes no read calls
+        with closing(__map_file(input_file)) as input_view:
+            element_reader = ElementReader(input_file, input_view, element_index, profile, {})
+
+            if in_place:
+                copy_statistics = __new_copy_statistics()
+                in_place_edits = []
+
+                # each in place edit leaves a valid file, so the edits are located and applied one after another...
+                while edit_functions:
+                    edit_function, edit_arguments = edit_functions[0]
+
+                    with profile.phase("locate"):
+                        edit = edit_function(element_reader, *edit_arguments)
+
+                    with profile.phase("plan"):
+                        in_place_writes = __plan_in_place_edit(element_reader, edit)
+
+                    if in_place_writes is None:
+                        break
+
+                    with profile.phase("copy"):
+                        for offset, data in in_place_writes:
+                            input_file.seek(offset)
+                            input_file.write(data)
+                            copy_statistics["written"] += len(data)
+
+                        # the next edit is located through the map and any rewrite copies through the descriptor, neither of which sees buffered writes
+                        input_file.flush()
+
+                    # ...moving elements about, so the index no longer describes the file
+                    in_place_edits.append((edit_functions[0], edit))
+                    edit_functions = edit_functions[1:]
+                    element_reader = ElementReader(input_file, input_view, None, profile, {})
+
+                if not edit_functions:
+                    if verify:
+                        with profile.phase("verify"):
+                            __verify_edits(ElementReader(input_file, input_view, None, profile, {}), in_place_edits)
+
+                    return copy_statistics
+
+                # ...until one cannot be absorbed by padding, when the remaining edits are rewritten into a temporary file which then replaces the input
+                temporary_file_descriptor, temporary_filename = mkstemp(dir = dirname(abspath(output_filename)), suffix = ".tmp")
+                close(temporary_file_descriptor)
+                copymode(input_filename, temporary_filename)
+
+                try:
+                    with profile.phase("locate"):
+                        edits = [edit_function(element_reader, *edit_arguments) for edit_function, edit_arguments in edit_functions]
+
+                    unchanged_digests = [] if verify == "full" else None
+                    with open(temporary_filename, "wb") as output_file:
+                        rewrite_statistics = __rewrite_file(element_reader, ProfiledFile(output_file, profile), edits, profile, unchanged_digests, parallel_copy)
+
+                    if verify:
+                        with profile.phase("verify"):
+                            __verify_output_file(temporary_filename, in_place_edits + list(zip(edit_functions, edits)), unchanged_digests, profile)
+
+                except:
+                    remove(temporary_filename)
+                    raise
+
+                rename(temporary_filename, output_filename)
+                return dict((key, copy_statistics[key] + rewrite_statistics[key]) for key in copy_statistics)
+
+            with profile.phase("locate"):
+                edits = [edit_function(element_reader, *edit_arguments) for edit_function, edit_arguments in edit_functions]
+
+            # write out the new file, either so that an interrupted copy can pick up where it left off...
+            if resumable_copy is not None:
+                if output_filename == "-":
+                    raise Exception("Cannot resume a copy to standard output.")
+
+                copy_statistics = __rewrite_file_resumably(element_reader, output_filename, edits, resumable_copy, profile)
+
+                # ...when only the edited elements can be verified, the unchanged bytes not all having been copied by this run...
+                if verify:
+                    with profile.phase("verify"):
+                        try:
+                            __verify_output_file(output_filename, list(zip(edit_functions, edits)), [], profile)
+
+                        except:
+                            remove(output_filename)
+                            raise
+
+                return copy_statistics
+
+            # ...or in one go
+            unchanged_digests = [] if verify == "full" else None
+            with __open_file(output_filename, "wb") as output_file:
+                if verify and not S_ISREG(fstat(output_file.fileno()).st_mode):
+                    raise Exception("Cannot verify an output which is not a regular file unless the input is streamed.")
+
+                copy_statistics = __rewrite_file(element_reader, ProfiledFile(output_file, profile), edits, profile, unchanged_digests, parallel_copy)
+
+            # an output which fails verification is not left behind to be mistaken for a good one
+            if verify:
+                with profile.phase("verify"):
+                    try:
+                        __verify_output_file(output_filename, list(zip(edit_functions, edits)), unchanged_digests, profile)
+
+                    except:
+                        remove(output_filename)
+                        raise
+
+            return copy_statistics
+
+
+def __plan_edit_file(input_filename, output_filename, edit_functions, element_index_location, copy_rate, profile):
+
+    if input_filename == "-":
+        raise Exception("Cannot plan an edit of standard input.")
+
+    # only the input's element heads are read, the output is never opened
+    in_place = exists(output_filename) and samefile(input_filename, output_filename)
+
+    with open(input_filename, "rb") as opened_input_file:
+        input_file = ProfiledFile(opened_input_file, profile)
+
+        with profile.phase("index"):
+            element_index = __load_element_index(element_index_location, input_filename, input_file)
+
+        with closing(__map_file(input_file)) as input_view:
+            element_reader = ElementReader(input_file, input_view, element_index, profile, {})
+            input_size = len(input_view)
+
+            with profile.phase("locate"):
+                edits = [edit_function(element_reader, *edit_arguments) for edit_function, edit_arguments in edit_functions]
+
+            with profile.phase("plan"):
+                in_place_writes_list = [__plan_in_place_edit(element_reader, edit) for edit in edits]
+                replaced_byte_ranges = __plan_rewrite(element_reader, edits)
+
+                edit_descriptions = [__describe_edit(edit, in_place_writes) for edit, in_place_writes in zip(edits, in_place_writes_list)]
+                replaced_byte_range_descriptions = [__describe_replaced_byte_range(input_view, replaced_byte_range) for replaced_byte_range in replaced_byte_ranges]
+
+    # the edits are planned against the input as it is, so they can be made in place together only while their writes stay apart
+    in_place_writes = sorted(write for in_place_writes in in_place_writes_list if in_place_writes is not None for write in in_place_writes)
+    in_place_possible = None not in in_place_writes_list and all(offset + len(data) <= next_offset for (offset, data), (next_offset, next_data) in zip(in_place_writes, in_place_writes[1:]))
+
+    # a rewrite copies the input around the replaced byte ranges
+    copied_byte_ranges = []
+    input_offset = 0
+    output_offset = 0
+
+    for offset, size, data in replaced_byte_ranges + [(input_size, 0, bytearray())]:
+        if offset > input_offset:
+            copied_byte_ranges.append([input_offset, output_offset, offset - input_offset])
+
+        output_offset += offset - input_offset + len(data)
+        input_offset = offset + size
+
+    bytes_to_write = sum(len(data) for offset, data in in_place_writes) if in_place and in_place_possible else output_offset
+
+    return {
+        "mode": "in_place" if in_place and in_place_possible else "rewrite",
+        "in_place_possible": in_place_possible,
+        "edits": edit_descriptions,
+        "replaced_byte_ranges": replaced_byte_range_descriptions,
+        "copied_byte_ranges": copied_byte_ranges,
+        "input_size": input_size,
+        "output_size": input_size if in_place and in_place_possible else output_offset,
+        "bytes_to_write": bytes_to_write,
+        "estimated_seconds": bytes_to_write / (copy_rate * 1024 * 1024)}
+
+
+def __describe_edit(edit, in_place_writes):
+
+    element_metadata = edit.element_metadata_path[-1]
+
+    # an in place edit either fits the old element exactly (by widening its size descriptor) or relies on padding
+    in_place_method = None
+    if in_place_writes is not None:
+        in_place_method = "padding"
+
+        if len(in_place_writes) == 1 and edit.new_body is not None:
+            element_id, element_size, head_size = __read_element_head(in_place_writes[0][1], 0)
+            if head_size + element_size == element_metadata.size:
+                in_place_method = "fits"
+
+    return {
+        "element": __ELEMENT_NAMES.get(element_metadata.id, hex(element_metadata.id)),
+        "offset": element_metadata.offset,
+        "size": element_metadata.size,
+        "new_size": len(__encode_element(element_metadata.id, edit.new_body)),
+        "in_place": in_place_method}
+
+
+def __describe_replaced_byte_range(input_view, replaced_byte_range):
+
+    offset, size, data = replaced_byte_range
+
+    # the replacement starts with the new element head, except where an element is removed altogether
+    if data:
+        element_id, new_body_size, head_size = __read_element_head(data, 0)
+
+    else:
+        element_id, new_body_size = __read_element_head(input_view, offset)[0], None
+
+    return {
+        "element": __ELEMENT_NAMES.get(element_id, hex(element_id)),
+        "offset": offset,
+        "size": size,
+        "new_size": len(data),
+        "new_body_size": new_body_size}
+
+
+def __write_stats(stats):
+
+    for phase_name in sorted(stats["phases"]):
+        stderr.write("{0} phase: {1:.6f}s wall, {2:.6f}s cpu\n".format(phase_name, stats["phases"][phase_name]["wall_seconds"], stats["phases"][phase_name]["cpu_seconds"]))
+
+    stderr.write("elements visited: {0}\n".format(stats["elements_visited"]))
+    stderr.write("bytes read: {0} in {1} call(s)\n".format(stats["bytes_read"], stats["read_calls"]))
+    stderr.write("bytes written: {0} in {1} call(s)\n".format(stats["bytes_written"], stats["write_calls"]))
+    stderr.write("bytes copied by the kernel: {0}\n".format(stats["kernel_copied_bytes"]))
+    stderr.write("bytes copied by threads: {0}\n".format(stats["threaded_copied_bytes"]))
+    stderr.write("peak memory of the process: {0} bytes, raised by {1} bytes during the edit\n".format(stats["process_peak_rss_bytes"], stats["peak_rss_growth_bytes"]))
+
+
+def __open_file(filename, mode):
+
+    # "-" stands for standard input or output, duplicated so that closing the file leaves the original open
+    if filename == "-":
+        standard_file = stdin if "r" in mode else stdout
+        standard_file.flush()
+        return fdopen(dup(standard_file.fileno()), mode)
+
+    return open(filename, mode)
+
+
+def __stream_file(input_file, output_file, edit_functions, verify, profile):
+
+    # everything ahead of the first cluster is small enough to hold, and holds every element the edits change
+    with profile.phase("locate"):
+        prefix = __read_stream_prefix(input_file)
+        element_reader = ElementReader(BytesIO(prefix), prefix, None, profile, {})
+        edits = [edit_function(element_reader, *edit_arguments) for edit_function, edit_arguments in edit_functions]
+
+        # a segment of unknown size (e.g. from a live muxer) stays that way, as its end is not known until the stream ends
+        segment_element_metadata = __find_segment_element_metadata(element_reader)
+        segment_size_known = __read_element_head(prefix, segment_element_metadata.offset)[1] is not None
+
+    with profile.phase("plan"):
+        replaced_byte_ranges = [replaced_byte_range for replaced_byte_range in __plan_rewrite(element_reader, edits) if replaced_byte_range[0] != segment_element_metadata.offset or segment_size_known]
+        new_prefix = __replace_byte_ranges(prefix, replaced_byte_ranges)
+
+    # the new head is checked before any of it is written, as a stream cannot be read back
+    if verify:
+        with profile.phase("verify"):
+            __verify_edits(ElementReader(BytesIO(new_prefix), new_prefix, None, profile, {}), list(zip(edit_functions, edits)))
+
+    with profile.phase("copy"):
+        copy_statistics = __new_copy_statistics()
+        copy_statistics["written"] = sum(len(data) for offset, size, data in replaced_byte_ranges)
+        copy_statistics["buffered"] = len(new_prefix) - copy_statistics["written"]
+        output_file.write(new_prefix)
+
+        # then pass the clusters, and anything after them, straight through
+        copy_statistics["buffered"] += __buffered_file_copy(input_file, output_file)
+
+        return copy_statistics
+
+
+def __replace_byte_ranges(data, replaced_byte_ranges):
+
+    new_data = bytearray()
+    offset = 0
+
+    for replaced_offset, replaced_size, replacement_data in replaced_byte_ranges:
+        new_data += data[offset:replaced_offset] + replacement_data
+        offset = replaced_offset + replaced_size
+
+    return new_data + data[offset:]
+
+
+def __read_stream_prefix(input_file):
+
+    prefix = bytearray()
+
+    # read whole top level elements, stepping into the segment, until the head of the first cluster
+    while True:
+        element_head = input_file.read(1)
+        if not element_head:
+            break
+
+        element_id_length = decode_vint_length(ord(element_head), False)[0]
+        element_head += __read_stream_data(input_file, element_id_length - 1)
+        element_size_head = __read_stream_data(input_file, 1)
+        element_head += element_size_head + __read_stream_data(input_file, decode_vint_length(ord(element_size_head))[0] - 1)
+        prefix += element_head
+
+        element_head_file = BytesIO(element_head)
+        element_id = read_element_id(element_head_file)[0]
+        element_size = read_element_size(element_head_file)[0]
+
+        if element_id == SegmentElement.id:
+            continue
+
+        elif element_id == ClusterElement.id:
+            break
+
+        elif element_size is None:
+            raise Exception("Cannot stream an element of unknown size ahead of the first {0} element.".format(ClusterElement.name))
+
+        prefix += __read_stream_data(input_file, element_size)
+
+    return prefix
+
+
+def __read_stream_data(input_file, number_of_bytes):
+
+    data = input_file.read(number_of_bytes)
+    if len(data) != number_of_bytes:
+        raise IOError("Unexpected end of stream.")
+
+    return data
+
+
+def __rewrite_file(element_reader, output_file, edits, profile, unchanged_digests = None, parallel_copy = None):
+
+    input_file = element_reader.file
+    input_size = len(element_reader.view)
+
+    # keep the unchanged data block aligned when the output can share extents with the input
+    with profile.phase("copy"):
+        copy_context = __new_copy_context(input_file, output_file, input_size, unchanged_digests, parallel_copy)
+
+    with profile.phase("plan"):
+        replaced_byte_ranges = __plan_rewrite(element_reader, edits, copy_context.reflink_block_size)
+
+    with profile.phase("copy"):
+        if copy_context.parallel_copy is not None:
+            return __copy_around_byte_ranges_in_parallel(input_file, output_file, input_size, replaced_byte_ranges, copy_context, profile)
+
+        return __copy_around_byte_ranges(input_file, output_file, input_size, replaced_byte_ranges, copy_context)
+
+
+def __copy_around_byte_ranges(input_file, output_file, input_size, replaced_byte_ranges, copy_context):
+
+    input_offset = 0
+    output_offset = 0
+
+    # copy the input around each replaced byte range in a single pass
+    for offset, size, data in replaced_byte_ranges + [(input_size, 0, bytearray())]:
+        if copy_context.unchanged_digests is None:
+            __copy_byte_range(input_file, output_file, input_offset, output_offset, offset - input_offset, copy_context)
+
+        else:
+            # when verifying, the unchanged bytes pass through here so that they can be hashed on their way
+            unchanged_hash = __verification_hash()
+            input_file.seek(input_offset)
+            copy_context.copy_statistics["buffered"] += __buffered_file_copy(input_file, output_file, offset - input_offset, unchanged_hash)
+            copy_context.unchanged_digests.append((output_offset, offset - input_offset, unchanged_hash.digest()))
+
+        output_offset += offset - input_offset
+
+        output_file.write(data)
+        copy_context.copy_statistics["written"] += len(data)
+
+        output_offset += len(data)
+        input_offset = offset + size
+
+    # the probing clone may have left the output longer than the data written
+    if copy_context.reflink_block_size is not None:
+        output_file.truncate(output_offset)
+
+    return copy_context.copy_statistics
+
+
+def __copy_around_byte_ranges_in_parallel(input_file, output_file, input_size, replaced_byte_ranges, copy_context, profile):
+
+    chunk_size = copy_context.parallel_copy.chunk_size
+    chunks = []
+    input_offset = 0
+    output_offset = 0
+
+    # the plan fixes where every byte of the output goes, so the new data is written in place and the unchanged data split into chunks which may land in any order
+    for offset, size, data in replaced_byte_ranges + [(input_size, 0, bytearray())]:
+        for chunk_offset in range(input_offset, offset, chunk_size):
+            chunks.append((chunk_offset, output_offset + chunk_offset - input_offset, min(chunk_size, offset - chunk_offset)))
+
+        output_offset += offset - input_offset
+
+        output_file.seek(output_offset)
+        output_file.write(data)
+        copy_context.copy_statistics["written"] += len(data)
+
+        output_offset += len(data)
+        input_offset = offset + size
+
+    output_file.flush()
+
+    # each thread holds a single chunk at a time, bounding the memory used by the number of threads
+    thread_pool = ThreadPool(copy_context.parallel_copy.threads)
+    try:
+        copy_chunk = lambda chunk: __copy_chunk(input_file.fileno(), output_file.fileno(), chunk[0], chunk[1], chunk[2], copy_context.unchanged_digests is not None)
+
+        # the threads' reads and writes bypass the profiled files, so they are counted here as each chunk completes
+        for chunk_output_offset, chunk_size, chunk_digest, read_calls, write_calls in thread_pool.imap_unordered(copy_chunk, chunks):
+            copy_context.copy_statistics["threaded"] += chunk_size
+            profile.bytes_read += chunk_size
+            profile.read_calls += read_calls
+            profile.bytes_written += chunk_size
+            profile.write_calls += write_calls
+
+            if chunk_digest is not None:
+                copy_context.unchanged_digests.append((chunk_output_offset, chunk_size, chunk_digest))
+
+    finally:
+        thread_pool.close()
+        thread_pool.join()
+
+    output_file.seek(output_offset)
+
+    return copy_context.copy_statistics
+
+
+def __copy_chunk(input_file_descriptor, output_file_descriptor, input_offset, output_offset, number_of_bytes, hash_chunk):
+
+    chunk_hash = __verification_hash() if hash_chunk else None
+    copied_bytes = 0
+    read_calls = 0
+    write_calls = 0
+
+    # positioned reads and writes leave the files' offsets alone, so every thread can share the same descriptors
+    while copied_bytes < number_of_bytes:
+        data = __pread(input_file_descriptor, number_of_bytes - copied_bytes, input_offset + copied_bytes)
+        read_calls += 1
+
+        if not data:
+            raise IOError("Unexpected end of file.")
+
+        written_bytes = 0
+        while written_bytes < len(data):
+            written_bytes += __pwrite(output_file_descriptor, data[written_bytes:], output_offset + copied_bytes + written_bytes)
+            write_calls += 1
+
+        if chunk_hash is not None:
+            chunk_hash.update(data)
+
+        copied_bytes += len(data)
+
+    return (output_offset, number_of_bytes, chunk_hash.digest() if chunk_hash is not None else None, read_calls, write_calls)
+
+
+def __rewrite_file_resumably(element_reader, output_filename, edits, resumable_copy, profile):
+
+    input_file = element_reader.file
+    input_size = len(element_reader.view)
+    partial_filename = output_filename + ".mkvedit-partial"
+    checkpoint_filename = output_filename + ".mkvedit-checkpoint"
+
+    # extents cannot be shared here, as the probing clone would overwrite the start of a partial file being resumed
+    with profile.phase("plan"):
+        replaced_byte_ranges = __plan_rewrite(element_reader, edits)
+
+    # a checkpoint only applies to the same input and the same edits
+    input_file_status = fstat(input_file.fileno())
+    plan_hash = __verification_hash()
+    for offset, size, data in replaced_byte_ranges:
+        plan_hash.update("{0}:{1}:".format(offset, size).encode("ascii") + bytes(data))
+
+    checkpoint_identity = [input_file_status.st_dev, input_file_status.st_ino, input_file_status.st_size, input_file_status.st_mtime, plan_hash.hexdigest()]
+
+    with profile.phase("copy"):
+        # open the partial file for reading as well, so that checkpoints can hash what it holds
+        if not exists(partial_filename):
+            open(partial_filename, "wb").close()
+
+        with open(partial_filename, "r+b") as opened_output_file:
+            output_file = ProfiledFile(opened_output_file, profile)
+            resume_offset = __read_checkpoint(checkpoint_filename, output_file, checkpoint_identity)
+
+            output_file.truncate(resume_offset)
+            output_file.seek(resume_offset)
+
+            copy_context = CopyContext(None, True, list(__ZERO_COPY_METHODS), __new_copy_statistics(), None, None)
+            __advise_file(input_file.fileno(), 0, 0, __POSIX_FADV_SEQUENTIAL)
+
+            # lay the copied and replaced pieces of the output end to end, skipping whatever an earlier run already wrote
+            output_offset = 0
+            writeback = [resume_offset, resume_offset, 0]	# output offset written back to, checkpointed to and input offset dropped to
+
+            input_offset = 0
+            for offset, size, data in replaced_byte_ranges + [(input_size, 0, bytearray())]:
+                for piece_input_offset, piece_size, piece_data in ((input_offset, offset - input_offset, None), (None, len(data), data)):
+                    skipped_size = min(piece_size, max(0, resume_offset - output_offset))
+                    output_offset = __write_resumable_piece(input_file, output_file, piece_input_offset, piece_size, piece_data, output_offset, skipped_size, copy_context, resumable_copy, checkpoint_filename, checkpoint_identity, writeback)
+
+                input_offset = offset + size
+
+            # the partial file becomes the output only once every byte of it is safely on disk
+            output_file.flush()
+            fsync(output_file.fileno())
+
+        rename(partial_filename, output_filename)
+        if exists(checkpoint_filename):
+            remove(checkpoint_filename)
+
+    return copy_context.copy_statistics
+
+
+def __write_resumable_piece(input_file, output_file, input_offset, size, data, output_offset, skipped_size, copy_context, resumable_copy, checkpoint_filename, checkpoint_identity, writeback):
+
+    output_offset += skipped_size
+    size -= skipped_size
+    if input_offset is not None:
+        input_offset += skipped_size
+
+    else:
+        data = data[skipped_size:]
+
+    # write in pieces no larger than the write back interval, so that the data written so far can be flushed behind the copy
+    while size > 0:
+        chunk_size = min(size, resumable_copy.writeback_size - output_offset % resumable_copy.writeback_size)
+
+        if input_offset is not None:
+            __copy_file_data(input_file, output_file, input_offset, output_offset, chunk_size, copy_context)
+            input_offset += chunk_size
+
+        else:
+            output_file.write(data[:chunk_size])
+            copy_context.copy_statistics["written"] += chunk_size
+            data = data[chunk_size:]
+
+        output_offset += chunk_size
+        size -= chunk_size
+
+        if output_offset % resumable_copy.writeback_size == 0:
+            __write_back(input_file, output_file, output_offset, input_offset, resumable_copy, checkpoint_filename, checkpoint_identity, writeback)
+
+    return output_offset
+
+
+def __write_back(input_file, output_file, output_offset, input_offset, resumable_copy, checkpoint_filename, checkpoint_identity, writeback):
+
+    written_back_offset, checkpointed_offset, dropped_input_offset = writeback
+    output_file.flush()
+
+    # wait for the previous interval's write back while this one starts, then drop both the written output and the read input from the page cache
+    __sync_file_range(output_file.fileno(), written_back_offset, output_offset - written_back_offset, __SYNC_FILE_RANGE_WRITE)
+    __sync_file_range(output_file.fileno(), 0, written_back_offset, __SYNC_FILE_RANGE_WAIT_BEFORE | __SYNC_FILE_RANGE_WRITE | __SYNC_FILE_RANGE_WAIT_AFTER)
+    __advise_file(output_file.fileno(), 0, written_back_offset, __POSIX_FADV_DONTNEED)
+
+    if input_offset is not None and input_offset > dropped_input_offset:
+        __advise_file(input_file.fileno(), dropped_input_offset, input_offset - dropped_input_offset, __POSIX_FADV_DONTNEED)
+        dropped_input_offset = input_offset
+
+    # and every so often make sure all of it has reached the disk before recording how far the copy got
+    if output_offset - checkpointed_offset >= resumable_copy.checkpoint_size:
+        fsync(output_file.fileno())
+        __write_checkpoint(checkpoint_filename, output_file, checkpoint_identity, output_offset)
+        checkpointed_offset = output_offset
+
+    writeback[:] = [output_offset, checkpointed_offset, dropped_input_offset]
+
+
+def __read_checkpoint(checkpoint_filename, output_file, checkpoint_identity):
+
+    if not exists(checkpoint_filename):
+        return 0
+
+    with open(checkpoint_filename, "r") as checkpoint_file:
+        checkpoint = loads(checkpoint_file.read())
+
+    # resume only where the partial file still holds exactly what was checkpointed, otherwise start over
+    if checkpoint["identity"] != checkpoint_identity or fstat(output_file.fileno()).st_size < checkpoint["output_offset"]:
+        return 0
+
+    if __hash_checkpointed_bytes(output_file, checkpoint["output_offset"]) != checkpoint["digest"]:
+        return 0
+
+    return checkpoint["output_offset"]
+
+
+def __write_checkpoint(checkpoint_filename, output_file, checkpoint_identity, output_offset):
+
+    checkpoint = {"identity": checkpoint_identity, "output_offset": output_offset, "digest": __hash_checkpointed_bytes(output_file, output_offset)}
+
+    # replace the checkpoint atomically so that a kill mid-write leaves the previous one
+    temporary_file_descriptor, temporary_filename = mkstemp(dir = dirname(abspath(checkpoint_filename)), suffix = ".tmp")
+    with fdopen(temporary_file_descriptor, "w") as checkpoint_file:
+        checkpoint_file.write(dumps(checkpoint))
+        checkpoint_file.flush()
+        fsync(checkpoint_file.fileno())
+
+    rename(temporary_filename, checkpoint_filename)
+
+
+def __hash_checkpointed_bytes(output_file, output_offset):
 
-        new_segment_element_body_size = segment_element_metadata.element.body_size + new_info_element_head_size + new_info_element_body_size - info_element_metadata.element.stream.size
-        new_segment_element_head_size = len(encode_element_size(new_segment_element_body_size)) + 4	# 4 byte element id (0x18538067)
+    # hashing the last stretch before the checkpoint catches a partial file that was truncated or rewritten since
+    start_offset = max(0, output_offset - __VERIFICATION_CHUNK_SIZE)
+    output_file.seek(start_offset)
+    checkpointed_hash = __verification_hash(output_file.read(output_offset - start_offset))
+    output_file.seek(output_offset)
 
-        # write out the new file
-        with open(output_filename, "wb") as output_file:
+    return checkpointed_hash.hexdigest()
 
-            # write the pre-segment header block
-            input_file.seek(0)
-            __buffered_file_copy(input_file, output_file, segment_element_metadata.offset)
 
-            # write the segment header
-            output_file.write(encode_element_id(SegmentElement.id))
-            output_file.write(encode_element_size(new_segment_element_body_size, MAXIMUM_ELEMENT_SIZE_LENGTH))
+def __plan_rewrite(element_reader, edits, alignment = None):
 
-            # write the post-segment header block / pre-info header block
-            input_file.seek(segment_element_metadata.element.head_size, SEEK_CUR)
-            __buffered_file_copy(input_file, output_file, info_element_metadata.offset - (segment_element_metadata.offset + segment_element_metadata.element.head_size))
+    replacements = {}
+    new_body_sizes = {}
+    size_differences = {}
+    parent_element_metadata_list = {}
+    child_element_offsets = {}
 
-            # write the info header
-            output_file.write(encode_element_id(InfoElement.id))
-            output_file.write(encode_element_size(new_info_element_body_size))
+    # calculate the edited elements...
+    for edit in edits:
+        element_metadata = edit.element_metadata_path[-1]
 
-            # write the post-info header block / pre-muxingapp header block
-            input_file.seek(info_element_metadata.element.head_size, SEEK_CUR)
-            __buffered_file_copy(input_file, output_file, muxingapp_element_metadata.offset - (info_element_metadata.offset + info_element_metadata.element.head_size))
+        if element_metadata.offset in replacements:
+            raise Exception("Cannot apply more than one edit to the element at offset {0}.".format(element_metadata.offset))
 
-            # write the muxingapp header
-            output_file.write(encode_element_id(MuxingAppElement.id))
-            output_file.write(encode_element_size(new_muxingapp_element_body_size))
+        new_element = __encode_element(element_metadata.id, edit.new_body)
+        replacements[element_metadata.offset] = (element_metadata.offset, element_metadata.size, new_element)
+        size_differences[element_metadata.offset] = len(new_element) - element_metadata.size
 
-            # write the muxingapp
-            output_file.write(encode_unicode_string(new_muxingapp))
+        # ...and note which of their parents are affected, however many edits share them
+        for depth in range(0, len(edit.element_metadata_path) - 1):
+            parent_element_metadata = edit.element_metadata_path[depth]
+            parent_element_metadata_list[parent_element_metadata.offset] = (depth, parent_element_metadata)
+            child_element_offsets.setdefault(parent_element_metadata.offset, set()).add(edit.element_metadata_path[depth + 1].offset)
 
-            # write the post-muxingapp block
-            input_file.seek(muxingapp_element_metadata.element.stream.size, SEEK_CUR)
-            __buffered_file_copy(input_file, output_file)
+    # calculate the combined size cascade of the parent heads once, innermost first
+    for depth, parent_element_metadata in sorted(parent_element_metadata_list.values(), key = lambda depth_and_element_metadata: -depth_and_element_metadata[0]):
+        new_parent_element_body_size = parent_element_metadata.body_size + sum(size_differences[child_element_offset] for child_element_offset in child_element_offsets[parent_element_metadata.offset])
+        new_parent_element_head = encode_element_id(parent_element_metadata.id) + encode_element_size(new_parent_element_body_size, MAXIMUM_ELEMENT_SIZE_LENGTH if parent_element_metadata.id == SegmentElement.id else None)
 
-            return       
+        replacements[parent_element_metadata.offset] = (parent_element_metadata.offset, parent_element_metadata.head_size, new_parent_element_head)
+        size_differences[parent_element_metadata.offset] = len(new_parent_element_head) + new_parent_element_body_size - parent_element_metadata.size
+        new_body_sizes[parent_element_metadata.offset] = new_parent_element_body_size
 
+    # recalculate the checksum of any edited parent which carries one, innermost first so that outer checksums cover the new inner ones
+    for depth, parent_element_metadata in sorted(parent_element_metadata_list.values(), key = lambda depth_and_element_metadata: -depth_and_element_metadata[0]):
+        crc32_element_metadata = __find_crc32_element_metadata(element_reader, parent_element_metadata)
 
-def change_writingapp(input_filename, output_filename, new_writingapp):
+        if crc32_element_metadata is not None:
+            checksum = __calculate_crc32(element_reader.view, crc32_element_metadata.offset + crc32_element_metadata.size, parent_element_metadata.offset + parent_element_metadata.size, [replacements[offset] for offset in sorted(replacements)])
+            replacements[crc32_element_metadata.offset] = (crc32_element_metadata.offset, crc32_element_metadata.size, __encode_element(CRC32Element.id, checksum, crc32_element_metadata.head_size - len(encode_element_id(CRC32Element.id))))
 
-    with open(input_filename, "rb") as input_file:
+    if alignment:
+        __align_rewrite(edits, replacements, new_body_sizes, alignment)
 
-        input_matroska_document = MatroskaDocument(input_file)
+    # the replaced byte ranges never overlap, so in input order they describe the output
+    return [replacements[offset] for offset in sorted(replacements)]
 
-        # retrieve element metadata
-        segment_element_metadata = __find_element_metadata(input_matroska_document.roots, SegmentElement, 0)
 
-        info_element_metadata = __find_element_metadata(segment_element_metadata.element.value, InfoElement, segment_element_metadata.offset + segment_element_metadata.element.head_size)
+def __align_rewrite(edits, replacements, new_body_sizes, alignment):
 
-        writingapp_element_metadata = __find_element_metadata(info_element_metadata.element.value, WritingAppElement, info_element_metadata.offset + info_element_metadata.element.head_size)
+    segment_element_metadata = edits[0].element_metadata_path[0]
+    replaced_byte_ranges = sorted(replacements.values())
+    padding = None
 
-        # calculate edited element sizes
-        new_writingapp_element_body_size = len(encode_unicode_string(new_writingapp))
-        new_writingapp_element_head_size = len(encode_element_size(new_writingapp_element_body_size)) + 2	# 2 byte element id (0x5741)
+    # find the longest unchanged byte range that follows an edited top level element...
+    for top_level_element_metadata in set(edit.element_metadata_path[1] for edit in edits):
+        padding_offset = top_level_element_metadata.offset + top_level_element_metadata.size
+        shift = sum(len(data) - size for offset, size, data in replaced_byte_ranges if offset < padding_offset)
+        unchanged_size = min([offset for offset, size, data in replaced_byte_ranges if offset >= padding_offset] + [segment_element_metadata.offset + segment_element_metadata.size]) - padding_offset
 
-        new_info_element_body_size = info_element_metadata.element.body_size + new_writingapp_element_head_size + new_writingapp_element_body_size - writingapp_element_metadata.element.stream.size
-        new_info_element_head_size = len(encode_element_size(new_info_element_body_size)) + 4	# 4 byte element id (0x1549A966)
+        if unchanged_size > 0 and (padding is None or unchanged_size > padding[0]):
+            padding = (unchanged_size, padding_offset, shift)
 
-        new_segment_element_body_size = segment_element_metadata.element.body_size + new_info_element_head_size + new_info_element_body_size - info_element_metadata.element.stream.size
-        new_segment_element_head_size = len(encode_element_size(new_segment_element_body_size)) + 4	# 4 byte element id (0x18538067)
+    if padding is None:
+        return
 
-        # write out the new file
-        with open(output_filename, "wb") as output_file:
+    # ...and insert a void after the element which shifts that range back onto the alignment
+    unchanged_size, padding_offset, shift = padding
+    padding_size = -shift % alignment
+    if padding_size == 1:
+        padding_size += alignment
 
-            # write the pre-segment header block
-            input_file.seek(0)
-            __buffered_file_copy(input_file, output_file, segment_element_metadata.offset)
+    if padding_size == 0:
+        return
 
-            # write the segment header
-            output_file.write(encode_element_id(SegmentElement.id))
-            output_file.write(encode_element_size(new_segment_element_body_size, MAXIMUM_ELEMENT_SIZE_LENGTH))
+    replacements[padding_offset] = (padding_offset, 0, __encode_void_element(padding_size, padding_size))
 
-            # write the post-segment header block / pre-info header block
-            input_file.seek(segment_element_metadata.element.head_size, SEEK_CUR)
-            __buffered_file_copy(input_file, output_file, info_element_metadata.offset - (segment_element_metadata.offset + segment_element_metadata.element.head_size))
+    new_body_sizes[segment_element_metadata.offset] += padding_size
+    replacements[segment_element_metadata.offset] = (segment_element_metadata.offset, segment_element_metadata.head_size, encode_element_id(SegmentElement.id) + encode_element_size(new_body_sizes[segment_element_metadata.offset], MAXIMUM_ELEMENT_SIZE_LENGTH))
 
-            # write the info header
-            output_file.write(encode_element_id(InfoElement.id))
-            output_file.write(encode_element_size(new_info_element_body_size))
 
-            # write the post-info header block / pre-writingapp header block
-            input_file.seek(info_element_metadata.element.head_size, SEEK_CUR)
-            __buffered_file_copy(input_file, output_file, writingapp_element_metadata.offset - (info_element_metadata.offset + info_element_metadata.element.head_size))
+def __plan_in_place_edit(element_reader, edit):
 
-            # write the writingapp header
-            output_file.write(encode_element_id(WritingAppElement.id))
-            output_file.write(encode_element_size(new_writingapp_element_body_size))
+    # a checksummed parent would need its checksum recalculating over bytes that may have moved, which is left to a rewrite
+    if any(__find_crc32_element_metadata(element_reader, parent_element_metadata) is not None for parent_element_metadata in edit.element_metadata_path[1:-1]):
+        return None
 
-            # write the writingapp
-            output_file.write(encode_unicode_string(new_writingapp))
+    element_metadata = edit.element_metadata_path[-1]
+    element_id_size = len(encode_element_id(element_metadata.id))
 
-            # write the post writingapp block
-            input_file.seek(writingapp_element_metadata.element.stream.size, SEEK_CUR)
-            __buffered_file_copy(input_file, output_file)
+    # a replacement can usually fill the old element exactly by widening its size descriptor...
+    if edit.new_body is not None:
+        size_length = element_metadata.size - element_id_size - len(edit.new_body)
 
-            return       
+        if size_length >= len(encode_element_size(len(edit.new_body))) and size_length <= MAXIMUM_ELEMENT_SIZE_LENGTH:
+            return [(element_metadata.offset, __encode_element(element_metadata.id, edit.new_body, size_length))]
 
+    new_element = __encode_element(element_metadata.id, edit.new_body)
+    size_difference = len(new_element) - element_metadata.size
+    element_end_offset = element_metadata.offset + element_metadata.size
 
-def change_trackuid(input_filename, output_filename, track_number, new_trackuid):
+    # ...otherwise look for a void to absorb the difference, starting with the element's siblings and working outwards
+    for level in reversed(range(1, len(edit.element_metadata_path))):
+        parent_element_metadata = edit.element_metadata_path[level - 1]
+        branch_element_metadata = edit.element_metadata_path[level]
 
-    with open(input_filename, "rb") as input_file:
+        # top level elements are indexed by offset so only a void directly after the branch may be used there
+        void_element_metadata = __find_following_void_element_metadata(element_reader, parent_element_metadata, branch_element_metadata, parent_element_metadata.id == SegmentElement.id)
+        if void_element_metadata is None:
+            continue
 
-        input_matroska_document = MatroskaDocument(input_file)
+        # a void cannot be a single byte long
+        new_void_element_size = void_element_metadata.size - size_difference
+        if new_void_element_size < 0 or new_void_element_size == 1:
+            continue
 
-        # retrieve element metadata
-        segment_element_metadata = __find_element_metadata(input_matroska_document.roots, SegmentElement, 0)
+        # the bytes in between are shifted through memory, so a void too far away is left for a rewrite to use (a further void being further still)
+        if void_element_metadata.offset - element_end_offset > __MAXIMUM_IN_PLACE_SHIFT_SIZE:
+            continue
 
-        tracks_element_metadata = __find_element_metadata(segment_element_metadata.element.value, TracksElement, segment_element_metadata.offset + segment_element_metadata.element.head_size)
+        # the branch elements between the edited element and the void keep their size descriptor length
+        writes = []
+        try:
+            for ancestor_element_metadata in edit.element_metadata_path[level:-1]:
+                ancestor_element_id = encode_element_id(ancestor_element_metadata.id)
+                writes.append((ancestor_element_metadata.offset, ancestor_element_id + encode_element_size(ancestor_element_metadata.body_size + size_difference, ancestor_element_metadata.head_size - len(ancestor_element_id))))
 
-        trackentry_element_metadata = __find_element_metadata(tracks_element_metadata.element.value, TrackEntryElement, tracks_element_metadata.offset + tracks_element_metadata.element.head_size, lambda e: e.id == TrackNumberElement.id and e.value == long(track_number))
+        except ValueError:
+            continue
 
-        trackuid_element_metadata = __find_element_metadata(trackentry_element_metadata.element.value, TrackUIDElement, trackentry_element_metadata.offset + trackentry_element_metadata.element.head_size)
+        # shift the bytes between the edited element and the void, then re-head the remaining void
+        element_reader.file.seek(element_end_offset)
+        shifted_data = element_reader.file.read(void_element_metadata.offset - element_end_offset)
+        new_void_element = __encode_void_element(new_void_element_size, void_element_metadata.head_size - size_difference)
 
-        # calculate edited element sizes
-        new_trackuid_element_body_size = len(encode_unsigned_integer(long(new_trackuid)))
-        new_trackuid_element_head_size = len(encode_element_size(new_trackuid_element_body_size)) + 2	# 2 byte element id (0x73C5)
+        writes.append((element_metadata.offset, new_element + shifted_data + new_void_element))
+        return writes
 
-        new_trackentry_element_body_size = trackentry_element_metadata.element.body_size + new_trackuid_element_head_size + new_trackuid_element_body_size - trackuid_element_metadata.element.stream.size
-        new_trackentry_element_head_size = len(encode_element_size(new_trackentry_element_body_size)) + 1	# 1 byte element id (0xAE)
+    # otherwise any freed bytes can become a new void in place of the old data
+    if size_difference <= -2:
+        return [(element_metadata.offset, new_element + __encode_void_element(-size_difference, -size_difference))]
 
-        new_tracks_element_body_size = tracks_element_metadata.element.body_size + new_trackentry_element_head_size + new_trackentry_element_body_size - trackentry_element_metadata.element.stream.size
-        new_tracks_element_head_size = len(encode_element_size(new_tracks_element_body_size)) + 4	# 4 byte element id (0x1654AE6B)
+    return None
 
-        new_segment_element_body_size = segment_element_metadata.element.body_size + new_tracks_element_head_size + new_tracks_element_body_size - tracks_element_metadata.element.stream.size
-        new_segment_element_head_size = len(encode_element_size(new_segment_element_body_size)) + 4	# 4 byte element id (0x18538067)
 
-        # write out the new file
-        with open(output_filename, "wb") as output_file:
+__MAXIMUM_IN_PLACE_SHIFT_SIZE = 1024 * 1024 * 16	# 16mb
 
-            # write the pre-segment header block
-            input_file.seek(0)
-            __buffered_file_copy(input_file, output_file, segment_element_metadata.offset)
 
-            # write the segment header
-            output_file.write(encode_element_id(SegmentElement.id))
-            output_file.write(encode_element_size(new_segment_element_body_size, MAXIMUM_ELEMENT_SIZE_LENGTH))
+def __find_following_void_element_metadata(element_reader, parent_element_metadata, branch_element_metadata, adjacent_only):
 
-            # write the post-segment header block / pre-tracks header block
-            input_file.seek(segment_element_metadata.element.head_size, SEEK_CUR)
-            __buffered_file_copy(input_file, output_file, tracks_element_metadata.offset - (segment_element_metadata.offset + segment_element_metadata.element.head_size))
+    branch_end_offset = branch_element_metadata.offset + branch_element_metadata.size
 
-            # write the tracks header
-            output_file.write(encode_element_id(TracksElement.id))
-            output_file.write(encode_element_size(new_tracks_element_body_size))
+    for element_metadata in __read_element_metadata_list(element_reader, branch_end_offset, parent_element_metadata.offset + parent_element_metadata.size):
+        if element_metadata.id == VoidElement.id:
+            return element_metadata
 
-            # write the post-tracks header block / pre-trackentry header block
-            input_file.seek(tracks_element_metadata.element.head_size, SEEK_CUR)
-            __buffered_file_copy(input_file, output_file, trackentry_element_metadata.offset - (tracks_element_metadata.offset + tracks_element_metadata.element.head_size))
+        elif adjacent_only:
+            break
 
-            # write the trackentry header
-            output_file.write(encode_element_id(TrackEntryElement.id))
-            output_file.write(encode_element_size(new_trackentry_element_body_size))
+    return None
 
-            # write the post-trackentry header block / pre-trackuid header block
-            input_file.seek(trackentry_element_metadata.element.head_size, SEEK_CUR)
-            __buffered_file_copy(input_file, output_file, trackuid_element_metadata.offset - (trackentry_element_metadata.offset + trackentry_element_metadata.element.head_size))
 
-            # write the trackuid header
-            output_file.write(encode_element_id(TrackUIDElement.id))
-            output_file.write(encode_element_size(new_trackuid_element_body_size))
+def __find_crc32_element_metadata(element_reader, parent_element_metadata):
 
-            # write the trackuid
-            output_file.write(encode_unsigned_integer(long(new_trackuid)))
+    # a crc-32 element, when present, is the first child of the element it covers; the segment is never checked, being far too large
+    if parent_element_metadata.id == SegmentElement.id or parent_element_metadata.body_size == 0:
+        return None
 
-            # write the post trackuid block
-            input_file.seek(trackuid_element_metadata.element.stream.size, SEEK_CUR)
-            __buffered_file_copy(input_file, output_file)
+    element_metadata = __read_element_metadata(element_reader, parent_element_metadata.offset + parent_element_metadata.head_size, parent_element_metadata.offset + parent_element_metadata.size)
+    return element_metadata if element_metadata.id == CRC32Element.id else None
 
-            return       
 
+def __calculate_crc32(view, start_offset, end_offset, replaced_byte_ranges = ()):
 
-def change_attachment_fileuid(input_filename, output_filename, attachment_filename, new_fileuid):
+    checksum = 0
+    offset = start_offset
 
-    with open(input_filename, "rb") as input_file:
+    # checksum the bytes as they will be once the replaced byte ranges within them are written
+    for replaced_offset, replaced_size, data in replaced_byte_ranges:
+        if start_offset <= replaced_offset < end_offset:
+            checksum = __calculate_view_crc32(view, offset, replaced_offset, checksum)
+            checksum = crc32(bytes(data), checksum)
+            offset = replaced_offset + replaced_size
 
-        input_matroska_document = MatroskaDocument(input_file)
+    # the checksum is stored little endian, unlike every other ebml value
+    return pack("<I", __calculate_view_crc32(view, offset, end_offset, checksum) & 0xFFFFFFFF)
 
-        # retrieve element metadata
-        segment_element_metadata = __find_element_metadata(input_matroska_document.roots, SegmentElement, 0)
 
-        attachments_element_metadata = __find_element_metadata(segment_element_metadata.element.value, AttachmentsElement, segment_element_metadata.offset + segment_element_metadata.element.head_size)
+def __calculate_view_crc32(view, start_offset, end_offset, checksum):
 
-        attachedfile_element_metadata = __find_element_metadata(attachments_element_metadata.element.value, AttachedFileElement, attachments_element_metadata.offset + attachments_element_metadata.element.head_size, lambda e: e.id == FileNameElement.id and e.value == attachment_filename)
+    for offset in range(start_offset, end_offset, __VERIFICATION_CHUNK_SIZE):
+        checksum = crc32(bytes(view[offset:min(offset + __VERIFICATION_CHUNK_SIZE, end_offset)]), checksum)
 
-        fileuid_element_metadata = __find_element_metadata(attachedfile_element_metadata.element.value, FileUIDElement, attachedfile_element_metadata.offset + attachedfile_element_metadata.element.head_size)
+    return checksum
 
-        # calculate edited element sizes
-        new_fileuid_element_body_size = len(encode_unsigned_integer(long(new_fileuid)))
-        new_fileuid_element_head_size = len(encode_element_size(new_fileuid_element_body_size)) + 2	# 2 byte element id (0x46AE)
 
-        new_attachedfile_element_body_size = attachedfile_element_metadata.element.body_size + new_fileuid_element_head_size + new_fileuid_element_body_size - fileuid_element_metadata.element.stream.size
-        new_attachedfile_element_head_size = len(encode_element_size(new_attachedfile_element_body_size)) + 2	# 2 byte element id (0x61A7)
+def __verify_output_file(output_filename, verified_edits, unchanged_digests, profile):
 
-        new_attachments_element_body_size = attachments_element_metadata.element.body_size + new_attachedfile_element_head_size + new_attachedfile_element_body_size - attachedfile_element_metadata.element.stream.size
-        new_attachments_element_head_size = len(encode_element_size(new_attachments_element_body_size)) + 4	# 4 byte element id (0x1941A469)
+    with open(output_filename, "rb") as output_file, closing(__map_file(output_file)) as output_view:
 
-        new_segment_element_body_size = segment_element_metadata.element.body_size + new_attachments_element_head_size + new_attachments_element_body_size - attachments_element_metadata.element.stream.size
-        new_segment_element_head_size = len(encode_element_size(new_segment_element_body_size)) + 4	# 4 byte element id (0x18538067)
+        # every unchanged byte range hashed on its way through must have arrived intact...
+        for offset, size, digest in unchanged_digests or []:
+            unchanged_hash = __verification_hash()
+            for chunk_offset in range(offset, offset + size, __VERIFICATION_CHUNK_SIZE):
+                unchanged_hash.update(output_view[chunk_offset:min(chunk_offset + __VERIFICATION_CHUNK_SIZE, offset + size)])
 
-        # write out the new file
-        with open(output_filename, "wb") as output_file:
+            if unchanged_hash.digest() != digest:
+                raise Exception("Verification failed: the {0} unchanged bytes at offset {1} differ from the input.".format(size, offset))
 
-            # write the pre-segment header block
-            input_file.seek(0)
-            __buffered_file_copy(input_file, output_file, segment_element_metadata.offset)
+        # ...around edited elements which parse
+        __verify_edits(ElementReader(output_file, output_view, None, profile, {}), verified_edits)
 
-            # write the segment header
-            output_file.write(encode_element_id(SegmentElement.id))
-            output_file.write(encode_element_size(new_segment_element_body_size, MAXIMUM_ELEMENT_SIZE_LENGTH))
 
-            # write the post-segment header block / pre-attachments header block
-            input_file.seek(segment_element_metadata.element.head_size, SEEK_CUR)
-            __buffered_file_copy(input_file, output_file, attachments_element_metadata.offset - (segment_element_metadata.offset + segment_element_metadata.element.head_size))
+def __verify_edits(element_reader, verified_edits):
 
-            # write the attachments header
-            output_file.write(encode_element_id(AttachmentsElement.id))
-            output_file.write(encode_element_size(new_attachments_element_body_size))
+    # the top level elements must exactly fill the segment, where the data reaches its end
+    segment_element_metadata = __find_segment_element_metadata(element_reader)
+    segment_end_offset = segment_element_metadata.offset + segment_element_metadata.size
+    offset = segment_element_metadata.offset + segment_element_metadata.head_size
 
-            # write the post-attachments header block / pre-attachedfile header block
-            input_file.seek(attachments_element_metadata.element.head_size, SEEK_CUR)
-            __buffered_file_copy(input_file, output_file, attachedfile_element_metadata.offset - (attachments_element_metadata.offset + attachments_element_metadata.element.head_size))
+    for element_metadata in __read_element_metadata_list(element_reader, offset, min(segment_end_offset, len(element_reader.view))):
+        offset = element_metadata.offset + element_metadata.size
 
-            # write the attachedfile header
-            output_file.write(encode_element_id(AttachedFileElement.id))
-            output_file.write(encode_element_size(new_attachedfile_element_body_size))
+    if segment_end_offset <= len(element_reader.view) and offset != segment_end_offset:
+        raise Exception("Verification failed: the top level elements overrun the {0} element.".format(SegmentElement.name))
 
-            # write the post-attachedfile header block / pre-fileuid header block
-            input_file.seek(attachedfile_element_metadata.element.head_size, SEEK_CUR)
-            __buffered_file_copy(input_file, output_file, fileuid_element_metadata.offset - (attachedfile_element_metadata.offset + attachedfile_element_metadata.element.head_size))
+    # locate each edited element afresh, checking it holds its new value within checksummed parents that still match
+    for (edit_function, edit_arguments), edit in verified_edits:
+        try:
+            new_edit = edit_function(element_reader, *edit_arguments)
 
-            # write the fileuid header
-            output_file.write(encode_element_id(FileUIDElement.id))
-            output_file.write(encode_element_size(new_fileuid_element_body_size))
+        except Exception:
+            new_edit = None
 
-            # write the fileuid
-            output_file.write(encode_unsigned_integer(long(new_fileuid)))
+        if edit.new_body is None:
+            if new_edit is not None:
+                raise Exception("Verification failed: the element at offset {0} was not removed.".format(new_edit.element_metadata_path[-1].offset))
 
-            # write the post fileuid block
-            input_file.seek(fileuid_element_metadata.element.stream.size, SEEK_CUR)
-            __buffered_file_copy(input_file, output_file)
+            continue
 
-            return       
+        if new_edit is None:
+            raise Exception("Verification failed: an edited element cannot be found.")
 
+        element_metadata = new_edit.element_metadata_path[-1]
+        if bytearray(element_reader.view[element_metadata.offset + element_metadata.head_size:element_metadata.offset + element_metadata.size]) != edit.new_body:
+            raise Exception("Verification failed: the element at offset {0} does not hold its new value.".format(element_metadata.offset))
 
-def __find_element_metadata(element_list, find_element, starting_offset, child_element_predicate = None):
+        for parent_element_metadata in new_edit.element_metadata_path[1:-1]:
+            crc32_element_metadata = __find_crc32_element_metadata(element_reader, parent_element_metadata)
 
-    ElementMetadata = namedtuple('ElementMetadata', 'element offset')
+            if crc32_element_metadata is not None and bytearray(element_reader.view[crc32_element_metadata.offset + crc32_element_metadata.head_size:crc32_element_metadata.offset + crc32_element_metadata.size]) != bytearray(__calculate_crc32(element_reader.view, crc32_element_metadata.offset + crc32_element_metadata.size, parent_element_metadata.offset + parent_element_metadata.size)):
+                raise Exception("Verification failed: the {0} element at offset {1} does not match its parent.".format(CRC32Element.name, crc32_element_metadata.offset))
 
-    offset = starting_offset
 
-    # enumerate the elements in the list until the requested element is found...
-    for element in element_list:
-        if element.id != find_element.id:
-            offset += element.stream.size
+__VERIFICATION_CHUNK_SIZE = 1024 * 1024
 
-        else:
-            if child_element_predicate is None:
-                # ...no predicate so just return it with the starting offset
-                return ElementMetadata(element, offset)
 
-            else:
-                # ....then evaluate the predicate and on matching return it with the starting offset
-                for child_element in element.value:
-                    if child_element_predicate(child_element):
-                        return ElementMetadata(element, offset)
+__ELEMENT_NAMES = dict((element.id, element.name) for element in (AttachmentsElement, AttachedFileElement, ClusterElement, CRC32Element, DateUTCElement, FileNameElement, FileUIDElement, InfoElement, MuxingAppElement, SeekHeaderElement, SeekIDElement, SeekPointElement, SeekPositionElement, SegmentElement, TracksElement, TrackEntryElement, TrackNumberElement, TrackUIDElement, VoidElement, WritingAppElement))
 
-                    else:
-                        offset += element.stream.size
-                        break
+
+def __encode_element(element_id, body, size_length = None):
+
+    # a missing body removes the element altogether
+    if body is None:
+        return bytearray()
+
+    return encode_element_id(element_id) + encode_element_size(len(body), size_length) + body
+
+
+def __encode_void_element(size, stale_size):
+
+    if size == 0:
+        return bytearray()
+
+    # choose the shortest size descriptor that fills the requested size exactly
+    for size_length in range(1, MAXIMUM_ELEMENT_SIZE_LENGTH + 1):
+        body_size = size - 1 - size_length
+
+        if 0 <= body_size <= maximum_element_size_for_length(size_length):
+            # only the stale bytes at the start of the body need clearing, any old void content may be left as is
+            return encode_element_id(VoidElement.id) + encode_element_size(body_size, size_length) + bytearray(max(0, min(body_size, stale_size - 1 - size_length)))
+
+    raise ValueError("Cannot encode a {0} byte {1} element.".format(size, VoidElement.name))
+
+
+class ElementMetadata(namedtuple("ElementMetadata", "id offset head_size body_size")):
+    """Describes where an element sits within a matroska file, as read from its head alone."""
+
+    __slots__ = ()
+
+    @property
+    def size(self):
+        return self.head_size + self.body_size
+
+
+class EditProfile(object):
+    """Collects the time spent in each phase of an edit along with the reads and writes it made."""
+
+    def __init__(self):
+        self.phases = {}
+        self.elements_visited = 0
+        self.bytes_read = 0
+        self.bytes_written = 0
+        self.read_calls = 0
+        self.write_calls = 0
+
+        # the process' peak memory only ever grows, so an edit run among others (e.g. by run_jobs) can only be told apart by how far it raised it
+        self.start_peak_rss_bytes = getrusage(RUSAGE_SELF).ru_maxrss * 1024
+
+    @contextmanager
+    def phase(self, phase_name):
+        start_wall_time = time()
+        start_cpu_time = sum(times()[:2])
+
+        try:
+            yield
+
+        finally:
+            # phases entered more than once (e.g. for each in place edit) accumulate
+            phase = self.phases.setdefault(phase_name, {"wall_seconds": 0.0, "cpu_seconds": 0.0})
+            phase["wall_seconds"] += time() - start_wall_time
+            phase["cpu_seconds"] += sum(times()[:2]) - start_cpu_time
+
+    def report(self, copy_statistics):
+        return {
+            "phases": dict((phase_name, dict(phase)) for phase_name, phase in self.phases.items()),
+            "elements_visited": self.elements_visited,
+            "bytes_read": self.bytes_read,
+            "bytes_written": self.bytes_written,
+            "read_calls": self.read_calls,
+            "write_calls": self.write_calls,
+            "kernel_copied_bytes": sum(copy_statistics.get(copy_method, 0) for copy_method in ("reflink", "copy_file_range", "sendfile")),
+            "threaded_copied_bytes": copy_statistics.get("threaded", 0),
+            "process_peak_rss_bytes": getrusage(RUSAGE_SELF).ru_maxrss * 1024,
+            "peak_rss_growth_bytes": getrusage(RUSAGE_SELF).ru_maxrss * 1024 - self.start_peak_rss_bytes}
+
+
+class ProfiledFile(object):
+    """Wraps a file object, counting the reads and writes made through it for an edit profile."""
+
+    def __init__(self, file_object, profile):
+        self.file_object = file_object
+        self.profile = profile
+
+    def read(self, *arguments):
+        data = self.file_object.read(*arguments)
+        self.profile.read_calls += 1
+        self.profile.bytes_read += len(data)
+        return data
+
+    def write(self, data):
+        self.file_object.write(data)
+        self.profile.write_calls += 1
+        self.profile.bytes_written += len(data)
+
+    def __getattr__(self, name):
+        return getattr(self.file_object, name)
+
+
+ElementEdit = namedtuple("ElementEdit", "element_metadata_path new_body")
+
+
+ElementReader = namedtuple("ElementReader", "file view index profile lookups")
+
+
+ElementIndex = namedtuple("ElementIndex", "segment_element_metadata top_level_element_metadata child_element_metadata_lists")
+
+
+ResumableCopy = namedtuple("ResumableCopy", "checkpoint_size writeback_size")
+
+
+ParallelCopy = namedtuple("ParallelCopy", "threads chunk_size")
+
+
+CopyContext = namedtuple("CopyContext", "reflink_block_size output_seekable copy_methods copy_statistics unchanged_digests parallel_copy")
+
+
+def __find_segment_element_metadata(element_reader):
+
+    if element_reader.index is not None:
+        return element_reader.index.segment_element_metadata
+
+    # the segment follows the ebml header at the top level of the file
+    for element_metadata in __read_element_metadata_list(element_reader, 0, len(element_reader.view)):
+        if element_metadata.id == SegmentElement.id:
+            return element_metadata
+
+    raise Exception("No {0} element found.".format(SegmentElement.name))
+
+
+def __find_top_level_element_metadata(element_reader, segment_element_metadata, find_element):
+
+    if element_reader.index is not None and find_element.id in element_reader.index.top_level_element_metadata:
+        return element_reader.index.top_level_element_metadata[find_element.id]
+
+    # a truncated file (or the buffered head of a stream) may end before its segment does
+    segment_body_offset = segment_element_metadata.offset + segment_element_metadata.head_size
+    segment_end_offset = min(segment_element_metadata.offset + segment_element_metadata.size, len(element_reader.view))
+    cluster_offset = None
+
+    # walk the elements ahead of the first cluster, jumping straight to the requested element when a seekhead indexes it...
+    for element_metadata in __read_element_metadata_list(element_reader, segment_body_offset, segment_end_offset):
+        if element_metadata.id == find_element.id:
+            return element_metadata
+
+        elif element_metadata.id == SeekHeaderElement.id:
+            indexed_element_metadata = __find_indexed_element_metadata(element_reader, segment_element_metadata, element_metadata, find_element, set([element_metadata.offset]))
+            if indexed_element_metadata is not None:
+                return indexed_element_metadata
+
+        elif element_metadata.id == ClusterElement.id:
+            cluster_offset = element_metadata.offset
+            break
+
+    # ...and only walk the element heads beyond the first cluster when no seekhead indexed the element
+    if cluster_offset is not None:
+        for element_metadata in __read_element_metadata_list(element_reader, cluster_offset, segment_end_offset):
+            if element_metadata.id == find_element.id:
+                return element_metadata
+
+    raise Exception("No {0} element found.".format(find_element.name))
+
+
+def __find_indexed_element_metadata(element_reader, segment_element_metadata, seekhead_element_metadata, find_element, visited_seekhead_offsets):
+
+    segment_end_offset = segment_element_metadata.offset + segment_element_metadata.size
+
+    for seek_id, seek_offset in __read_seek_entries(element_reader, segment_element_metadata, seekhead_element_metadata):
+        if seek_id == find_element.id:
+            element_metadata = __read_indexed_element_metadata(element_reader, seek_offset, segment_end_offset, find_element.id)
+            if element_metadata is not None:
+                return element_metadata
+
+        elif seek_id == SeekHeaderElement.id and seek_offset not in visited_seekhead_offsets:
+            # follow chained seekheads (e.g. one written after the clusters)
+            visited_seekhead_offsets.add(seek_offset)
+            element_metadata = __read_indexed_element_metadata(element_reader, seek_offset, segment_end_offset, SeekHeaderElement.id)
+            if element_metadata is not None:
+                element_metadata = __find_indexed_element_metadata(element_reader, segment_element_metadata, element_metadata, find_element, visited_seekhead_offsets)
+                if element_metadata is not None:
+                    return element_metadata
+
+    return None
+
+
+def __read_seek_entries(element_reader, segment_element_metadata, seekhead_element_metadata):
+
+    segment_body_offset = segment_element_metadata.offset + segment_element_metadata.head_size
+    segment_end_offset = segment_element_metadata.offset + segment_element_metadata.size
+
+    for seek_element_metadata in __read_child_element_metadata_list(element_reader, seekhead_element_metadata):
+        if seek_element_metadata.id != SeekPointElement.id:
+            continue
+
+        # seek ids hold the encoded element id, which reads back as the id itself
+        seek_id = None
+        seek_position = None
+        for child_element_metadata in __read_child_element_metadata_list(element_reader, seek_element_metadata):
+            if child_element_metadata.id == SeekIDElement.id:
+                seek_id = __read_element_value(element_reader, child_element_metadata, read_unsigned_integer)
+
+            elif child_element_metadata.id == SeekPositionElement.id:
+                seek_position = __read_element_value(element_reader, child_element_metadata, read_unsigned_integer)
+
+        # seek positions are relative to the start of the segment body; ignore any that point outside it
+        if seek_id is not None and seek_position is not None and segment_body_offset + seek_position < segment_end_offset:
+            yield seek_id, segment_body_offset + seek_position
+
+
+def __read_indexed_element_metadata(element_reader, offset, end_offset, element_id):
+
+    # a stale seek position (e.g. from an edit that moved the element) may point at anything, so treat it as a miss
+    try:
+        element_metadata = __read_element_metadata(element_reader, offset, end_offset)
+
+    except (IOError, TypeError):
+        return None
+
+    return element_metadata if element_metadata.id == element_id else None
+
+
+def __find_element_metadata(element_reader, parent_element_metadata, find_element):
+
+    # enumerate the child elements of the parent until the requested element is found
+    for element_metadata in __read_child_element_metadata_list(element_reader, parent_element_metadata):
+        if element_metadata.id == find_element.id:
+            return element_metadata
 
     raise Exception("No {0} element found.".format(find_element.name))
 
 
-def __buffered_file_copy(input_file, output_file, number_of_bytes = None):
+def __find_keyed_element_metadata(element_reader, parent_element_metadata, find_element, key_element, key_reader, key):
+
+    lookup = (parent_element_metadata.offset, find_element.id, key_element.id)
+
+    # key every requested element under the parent in a single pass, so that later edits (e.g. to many attachments) need no rescan
+    if lookup not in element_reader.lookups:
+        keyed_element_metadata = {}
+
+        for element_metadata in __read_child_element_metadata_list(element_reader, parent_element_metadata):
+            if element_metadata.id != find_element.id:
+                continue
+
+            # only the key element's value is read, any other children (e.g. attachment data) are stepped over by their heads
+            for child_element_metadata in __read_child_element_metadata_list(element_reader, element_metadata):
+                if child_element_metadata.id == key_element.id:
+                    keyed_element_metadata.setdefault(__read_element_value(element_reader, child_element_metadata, key_reader), element_metadata)
+                    break
+
+        element_reader.lookups[lookup] = keyed_element_metadata
+
+    if key not in element_reader.lookups[lookup]:
+        raise Exception("No {0} element found.".format(find_element.name))
+
+    return element_reader.lookups[lookup][key]
+
+
+def __read_child_element_metadata_list(element_reader, parent_element_metadata):
+
+    if element_reader.index is not None and parent_element_metadata.offset in element_reader.index.child_element_metadata_lists:
+        return iter(element_reader.index.child_element_metadata_lists[parent_element_metadata.offset])
+
+    return __read_element_metadata_list(element_reader, parent_element_metadata.offset + parent_element_metadata.head_size, parent_element_metadata.offset + parent_element_metadata.size)
+
+
+def __read_element_metadata_list(element_reader, offset, end_offset):
+
+    # read only the element heads, stepping over each element body
+    while offset < end_offset:
+        element_metadata = __read_element_metadata(element_reader, offset, end_offset)
+        yield element_metadata
+
+        offset += element_metadata.size
+
+
+def __read_element_metadata(element_reader, offset, end_offset):
+
+    element_id, element_size, head_size = __read_element_head(element_reader.view, offset)
+
+    if element_reader.profile is not None:
+        element_reader.profile.elements_visited += 1
+
+    # an element of unknown size (e.g. a live segment) runs to the end of its parent
+    if element_size is None:
+        element_size = end_offset - (offset + head_size)
+
+    return ElementMetadata(element_id, offset, head_size, element_size)
+
+
+def __read_element_head(view, offset):
+
+    # element ids keep their length marker, so an id is simply the value of its bytes
+    element_id_size = __read_vint_length(view, offset)
+    if element_id_size > 4:
+        raise IOError("Cannot decode element ID with length > 4.")
+
+    element_id = __read_big_endian(view, offset, element_id_size)
+
+    # whereas a size drops its marker, and has every other bit set when unknown
+    element_size_size = __read_vint_length(view, offset + element_id_size)
+    element_size = __read_big_endian(view, offset + element_id_size, element_size_size) & __VINT_VALUE_MASKS[element_size_size]
+
+    return element_id, None if element_size == __VINT_VALUE_MASKS[element_size_size] else element_size, element_id_size + element_size_size
+
+
+def __read_vint_length(view, offset):
+
+    vint_length = __VINT_LENGTHS[__read_big_endian(view, offset, 1)]
+    if vint_length == 0:
+        raise IOError("Cannot decode invalid variable-length integer.")
+
+    return vint_length
+
+
+def __read_big_endian(view, offset, length):
+
+    if offset < 0 or offset + length > len(view):
+        raise IOError("Unexpected end of file.")
+
+    # unpack a whole word in place where the view allows, dropping the bytes beyond the requested length
+    if offset + 8 <= len(view):
+        return int(__BIG_ENDIAN_WORD.unpack_from(view, offset)[0] >> (64 - 8 * length))
+
+    return reduce(lambda value, byte: value << 8 | byte, bytearray(view[offset:offset + length]), 0)
+
+
+def __map_file(input_file):
+
+    # an empty file cannot be mapped, nor can it hold any elements
+    if fstat(input_file.fileno()).st_size == 0:
+        raise Exception("No {0} element found.".format(SegmentElement.name))
+
+    return mmap(input_file.fileno(), 0, access = ACCESS_READ)
+
+
+# the length of a variable length integer, tabulated by its first byte (0 where that byte is invalid), and the mask of its value bits
+__VINT_LENGTHS = tuple(next((length for length in range(1, 9) if byte & (0x100 >> length)), 0) for byte in range(256))
+__VINT_VALUE_MASKS = tuple((1 << (7 * length)) - 1 for length in range(0, 9))
+__BIG_ENDIAN_WORD = Struct(">Q")
+
+
+def __read_element_value(element_reader, element_metadata, reader):
+
+    element_reader.file.seek(element_metadata.offset + element_metadata.head_size)
+    return reader(element_reader.file, element_metadata.body_size)
+
+
+def __build_element_index(element_reader):
+
+    segment_element_metadata = __find_segment_element_metadata(element_reader)
+    segment_end_offset = segment_element_metadata.offset + segment_element_metadata.size
+    top_level_element_metadata = {}
+    seekhead_element_metadata_list = []
+
+    # record the top level elements ahead of the first cluster...
+    for element_metadata in __read_element_metadata_list(element_reader, segment_element_metadata.offset + segment_element_metadata.head_size, segment_end_offset):
+        if element_metadata.id == ClusterElement.id:
+            break
+
+        top_level_element_metadata.setdefault(element_metadata.id, element_metadata)
+        if element_metadata.id == SeekHeaderElement.id:
+            seekhead_element_metadata_list.append(element_metadata)
+
+    # ...along with those any seekhead, or seekhead it points to, indexes
+    visited_seekhead_offsets = set(element_metadata.offset for element_metadata in seekhead_element_metadata_list)
+
+    while seekhead_element_metadata_list:
+        for seek_id, seek_offset in __read_seek_entries(element_reader, segment_element_metadata, seekhead_element_metadata_list.pop(0)):
+            if seek_id in top_level_element_metadata and not (seek_id == SeekHeaderElement.id and seek_offset not in visited_seekhead_offsets):
+                continue
+
+            element_metadata = __read_indexed_element_metadata(element_reader, seek_offset, segment_end_offset, seek_id)
+            if element_metadata is None:
+                continue
+
+            top_level_element_metadata.setdefault(seek_id, element_metadata)
+            if seek_id == SeekHeaderElement.id:
+                visited_seekhead_offsets.add(seek_offset)
+                seekhead_element_metadata_list.append(element_metadata)
+
+    # record the children of the top level elements that edits descend into
+    child_element_metadata_lists = {}
+    for element_metadata in top_level_element_metadata.values():
+        if element_metadata.id in (InfoElement.id, TracksElement.id, AttachmentsElement.id):
+            child_element_metadata_lists[element_metadata.offset] = list(__read_child_element_metadata_list(element_reader, element_metadata))
+
+    return ElementIndex(segment_element_metadata, top_level_element_metadata, child_element_metadata_lists)
+
+
+def __load_element_index(element_index_location, filename, input_file):
+
+    if element_index_location is None:
+        return None
+
+    # an index only describes the file it was built from, identified by inode, size and modification time
+    file_status = fstat(input_file.fileno())
+    serialised_element_index = None
+
+    if element_index_location is True:
+        sidecar_filename = filename + ".mkvedit-index"
+
+        if exists(sidecar_filename):
+            with open(sidecar_filename, "r") as sidecar_file:
+                sidecar = loads(sidecar_file.read())
+
+            if (sidecar["inode"], sidecar["size"], sidecar["mtime"]) == (file_status.st_ino, file_status.st_size, file_status.st_mtime):
+                serialised_element_index = sidecar["index"]
+
+    else:
+        connection = __connect_element_index_database(element_index_location)
+
+        try:
+            with connection:
+                row = connection.execute("SELECT data FROM element_index WHERE device = ? AND inode = ? AND size = ? AND mtime = ?", (file_status.st_dev, file_status.st_ino, file_status.st_size, file_status.st_mtime)).fetchone()
+
+                # note the use, as eviction drops the least recently used files first
+                if row is not None:
+                    serialised_element_index = loads(row[0])
+                    connection.execute("UPDATE element_index SET last_used = ? WHERE device = ? AND inode = ?", (time(), file_status.st_dev, file_status.st_ino))
+
+        finally:
+            connection.close()
+
+    if serialised_element_index is None:
+        return None
+
+    return ElementIndex(
+        ElementMetadata(*serialised_element_index["segment"]),
+        dict((element_metadata[0], ElementMetadata(*element_metadata)) for element_metadata in serialised_element_index["top_level"]),
+        dict((int(offset), [ElementMetadata(*element_metadata) for element_metadata in element_metadata_list]) for offset, element_metadata_list in serialised_element_index["children"].items()))
+
+
+def __save_element_index(element_index_location, filename, element_index_size):
+
+    with open(filename, "rb") as input_file, closing(__map_file(input_file)) as input_view:
+        element_index = __build_element_index(ElementReader(input_file, input_view, None, None, {}))
+        file_status = fstat(input_file.fileno())
+
+    serialised_element_index = dumps({
+        "segment": list(element_index.segment_element_metadata),
+        "top_level": [list(element_metadata) for element_metadata in element_index.top_level_element_metadata.values()],
+        "children": dict((str(offset), [list(element_metadata) for element_metadata in element_metadata_list]) for offset, element_metadata_list in element_index.child_element_metadata_lists.items())})
+
+    if element_index_location is True:
+        # replace the sidecar atomically so that a concurrent reader never sees half of it
+        sidecar_filename = filename + ".mkvedit-index"
+        temporary_file_descriptor, temporary_filename = mkstemp(dir = dirname(abspath(sidecar_filename)), suffix = ".tmp")
+
+        with fdopen(temporary_file_descriptor, "w") as sidecar_file:
+            sidecar_file.write(dumps({"inode": file_status.st_ino, "size": file_status.st_size, "mtime": file_status.st_mtime, "index": loads(serialised_element_index)}))
+
+        rename(temporary_filename, sidecar_filename)
+        return
+
+    connection = __connect_element_index_database(element_index_location)
+
+    try:
+        with connection:
+            connection.execute("INSERT OR REPLACE INTO element_index (device, inode, size, mtime, last_used, data) VALUES (?, ?, ?, ?, ?, ?)", (file_status.st_dev, file_status.st_ino, file_status.st_size, file_status.st_mtime, time(), serialised_element_index))
+
+            # keep the database bounded by evicting the least recently used files
+            connection.execute("DELETE FROM element_index WHERE rowid NOT IN (SELECT rowid FROM element_index ORDER BY last_used DESC LIMIT ?)", (element_index_size,))
+
+    finally:
+        connection.close()
+
+
+def __connect_element_index_database(database_filename):
+
+    # batch workers share the database, so wait out each other's writes
+    connection = connect(database_filename, timeout = 60)
+    connection.execute("CREATE TABLE IF NOT EXISTS element_index (device INTEGER, inode INTEGER, size INTEGER, mtime REAL, last_used REAL, data TEXT, PRIMARY KEY (device, inode))")
+    return connection
+
+
+def __new_copy_statistics():
+
+    # the bytes moved by each copy method, and the new data written by python
+    return {"reflink": 0, "copy_file_range": 0, "sendfile": 0, "threaded": 0, "buffered": 0, "written": 0}
+
+
+def __new_copy_context(input_file, output_file, input_size, unchanged_digests = None, parallel_copy = None):
+
+    try:
+        lseek(output_file.fileno(), 0, SEEK_CUR)
+        output_seekable = True
+
+    except OSError:
+        output_seekable = False
+
+    # copying from many threads needs to write at any offset of the output, and takes the place of the kernel's copy methods
+    if parallel_copy is not None and output_seekable:
+        return CopyContext(None, output_seekable, [], __new_copy_statistics(), unchanged_digests, parallel_copy)
+
+    # verifying copies every byte through python, so there is nothing to gain by sharing extents
+    if unchanged_digests is not None:
+        return CopyContext(None, output_seekable, [], __new_copy_statistics(), unchanged_digests, None)
+
+    return CopyContext(__probe_reflink_block_size(input_file, output_file, input_size), output_seekable, list(__ZERO_COPY_METHODS), __new_copy_statistics(), None, None)
+
+
+def __copy_byte_range(input_file, output_file, input_offset, output_offset, number_of_bytes, copy_context):
+
+    input_end_offset = input_offset + number_of_bytes
+    byte_ranges = [(input_offset, input_end_offset, False)]
+    reflink_block_size = copy_context.reflink_block_size
+
+    # clone the block aligned middle of the range where the input and output offsets share an alignment, copying the edges
+    if reflink_block_size is not None and (output_offset - input_offset) % reflink_block_size == 0:
+        clone_start_offset = -(-input_offset // reflink_block_size) * reflink_block_size
+        clone_end_offset = (input_end_offset // reflink_block_size) * reflink_block_size
+
+        if clone_start_offset < clone_end_offset:
+            byte_ranges = [(input_offset, clone_start_offset, False), (clone_start_offset, clone_end_offset, True), (clone_end_offset, input_end_offset, False)]
+
+    for start_offset, end_offset, clone in byte_ranges:
+        if start_offset == end_offset:
+            continue
+
+        if clone and __clone_file_range(input_file, output_file, start_offset, output_offset + start_offset - input_offset, end_offset - start_offset):
+            copy_context.copy_statistics["reflink"] += end_offset - start_offset
+            output_file.seek(output_offset + end_offset - input_offset)
+
+        else:
+            __copy_file_data(input_file, output_file, start_offset, output_offset + start_offset - input_offset, end_offset - start_offset, copy_context)
+
+
+def __copy_file_data(input_file, output_file, input_offset, output_offset, number_of_bytes, copy_context):
+
+    MAXIMUM_ZERO_COPY_SIZE = 1024 * 1024 * 1024	# 1gb
+    copy_methods = copy_context.copy_methods
+    copied_bytes = 0
+
+    output_file.flush()
+
+    # let the kernel move the data where it can...
+    while copy_methods and copied_bytes < number_of_bytes:
+        copy_method_name, copy_method = copy_methods[0]
+
+        try:
+            copy_size = copy_method(input_file.fileno(), output_file.fileno(), input_offset + copied_bytes, output_offset + copied_bytes if copy_context.output_seekable else None, min(number_of_bytes - copied_bytes, MAXIMUM_ZERO_COPY_SIZE))
+
+        except EnvironmentError as error:
+            if error.errno not in __UNSUPPORTED_COPY_ERRORS:
+                raise
+
+            # ...dropping any method these files or this filesystem do not support...
+            copy_methods.pop(0)
+            continue
+
+        if copy_size == 0:
+            break
+
+        copied_bytes += copy_size
+        copy_context.copy_statistics[copy_method_name] += copy_size
+
+    # ...bringing the output file object back in step with what the kernel wrote...
+    if copied_bytes and copy_context.output_seekable:
+        output_file.seek(output_offset + copied_bytes)
+
+    # ...and copy whatever remains through python
+    if copied_bytes < number_of_bytes:
+        input_file.seek(input_offset + copied_bytes)
+        copy_context.copy_statistics["buffered"] += __buffered_file_copy(input_file, output_file, number_of_bytes - copied_bytes)
+
+
+def __probe_reflink_block_size(input_file, output_file, input_size):
+
+    input_file_status = fstat(input_file.fileno())
+    output_file_status = fstat(output_file.fileno())
+
+    # extents can only be shared between regular files on the same filesystem
+    if not S_ISREG(input_file_status.st_mode) or not S_ISREG(output_file_status.st_mode) or input_file_status.st_dev != output_file_status.st_dev:
+        return None
+
+    # clone the first block, which the rewrite overwrites anyway, to find out whether the filesystem supports it
+    block_size = fstatvfs(output_file.fileno()).f_bsize
+    if input_size < 2 * block_size or not __clone_file_range(input_file, output_file, 0, 0, block_size):
+        return None
+
+    return block_size
+
+
+def __clone_file_range(input_file, output_file, input_offset, output_offset, number_of_bytes):
+
+    FICLONERANGE = 0x4020940D	# _IOW(0x94, 13, struct file_clone_range)
+
+    output_file.flush()
+
+    try:
+        ioctl(output_file.fileno(), FICLONERANGE, pack("=qQQQ", input_file.fileno(), input_offset, number_of_bytes, output_offset))
+
+    except EnvironmentError:
+        return False
+
+    return True
+
+
+def __copy_file_range(input_file_descriptor, output_file_descriptor, input_offset, output_offset, number_of_bytes):
+
+    # only regular files are supported, which are always seekable
+    if output_offset is None:
+        raise OSError(EINVAL, strerror(EINVAL))
+
+    if __os_copy_file_range is not None:
+        return __os_copy_file_range(input_file_descriptor, output_file_descriptor, number_of_bytes, input_offset, output_offset)
+
+    # older pythons reach it through libc
+    return __call_libc_function("copy_file_range", input_file_descriptor, byref(c_int64(input_offset)), output_file_descriptor, byref(c_int64(output_offset)), c_size_t(number_of_bytes), c_uint(0))
+
+
+def __sendfile(input_file_descriptor, output_file_descriptor, input_offset, output_offset, number_of_bytes):
+
+    # sendfile writes at the output's file position, which for a pipe is simply its end
+    if output_offset is not None:
+        lseek(output_file_descriptor, output_offset, SEEK_SET)
+
+    if __os_sendfile is not None:
+        return __os_sendfile(output_file_descriptor, input_file_descriptor, input_offset, number_of_bytes)
+
+    # older pythons reach it through libc
+    return __call_libc_function("sendfile", output_file_descriptor, input_file_descriptor, byref(c_int64(input_offset)), c_size_t(number_of_bytes))
+
+
+def __pread(file_descriptor, number_of_bytes, offset):
+
+    if __os_pread is not None:
+        return __os_pread(file_descriptor, number_of_bytes, offset)
+
+    # older pythons reach it through libc, which lets go of the interpreter lock for the call as os.pread does
+    data_buffer = create_string_buffer(number_of_bytes)
+    read_bytes = __call_libc_function("pread", file_descriptor, data_buffer, c_size_t(number_of_bytes), c_int64(offset))
+
+    return data_buffer.raw[:read_bytes]
+
+
+def __pwrite(file_descriptor, data, offset):
+
+    if __os_pwrite is not None:
+        return __os_pwrite(file_descriptor, data, offset)
+
+    # older pythons reach it through libc
+    return __call_libc_function("pwrite", file_descriptor, c_char_p(bytes(data)), c_size_t(len(data)), c_int64(offset))
+
+
+def __call_libc_function(function_name, *arguments):
+
+    function = getattr(__LIBC, function_name, None)
+    if function is None:
+        raise OSError(ENOSYS, "{0} is not available.".format(function_name))
+
+    function.restype = c_ssize_t
+    result = function(*arguments)
+
+    if result < 0:
+        error_number = get_errno()
+        raise OSError(error_number, strerror(error_number))
+
+    return result
+
+
+def __advise_file(file_descriptor, offset, number_of_bytes, advice):
+
+    # page cache advice is only ever a hint, so wherever it cannot be given it is simply not given
+    try:
+        if __os_posix_fadvise is not None:
+            __os_posix_fadvise(file_descriptor, offset, number_of_bytes, advice)
+
+        elif getattr(__LIBC, "posix_fadvise", None) is not None:
+            __LIBC.posix_fadvise(file_descriptor, c_int64(offset), c_int64(number_of_bytes), advice)
+
+    except EnvironmentError:
+        pass
+
+
+def __sync_file_range(file_descriptor, offset, number_of_bytes, flags):
+
+    # as is write back control, the final fsync making sure of the data regardless
+    if number_of_bytes <= 0:
+        return
+
+    try:
+        __call_libc_function("sync_file_range", file_descriptor, c_int64(offset), c_int64(number_of_bytes), c_uint(flags))
+
+    except EnvironmentError:
+        pass
+
+
+__LIBC = CDLL(None, use_errno = True)
+__POSIX_FADV_SEQUENTIAL = 2
+__POSIX_FADV_DONTNEED = 4
+__SYNC_FILE_RANGE_WAIT_BEFORE = 1
+__SYNC_FILE_RANGE_WRITE = 2
+__SYNC_FILE_RANGE_WAIT_AFTER = 4
+__ZERO_COPY_METHODS = [("copy_file_range", __copy_file_range), ("sendfile", __sendfile)]
+__UNSUPPORTED_COPY_ERRORS = frozenset([EBADF, EINVAL, ENOSYS, EOPNOTSUPP, ENOTSUP, ESPIPE, EXDEV])
+
+
+def __buffered_file_copy(input_file, output_file, number_of_bytes = None, hash_object = None):
+
+    copied_bytes = 0
 
     # copy the input file piece-by-piece to avoid excessive memory use
     for data in __yielding_read(input_file, number_of_bytes):
         output_file.write(data)
+        copied_bytes += len(data)
+
+        if hash_object is not None:
+            hash_object.update(data)
+
+    return copied_bytes
 
 
 def __yielding_read(file_object, number_of_bytes = None):
@@ -390,14 +2216,13 @@ if __name__ == "__main__":
     if len(argv) < 2:
         raise Exception("Script expects at least a single argument representing the edit command.")
 
-    # does this script contain the requested command?
-    command_name = argv[1]
-    command_tuples = getmembers(modules[__name__], lambda member: isfunction(member) and member.__name__ == command_name)
-
-    if len(command_tuples) == 0:
-        raise Exception("Cannot find command %s." % command_name)
+    # invoke the requested command, passing any --name=value arguments as options
+    command = __find_command(argv[1])
+    arguments = [argument for argument in argv[2:] if not argument.startswith("--")]
+    options = dict(__parse_option(argument) for argument in argv[2:] if argument.startswith("--"))
+    result = command(*arguments, **options)
 
-    # invoke the requested command
-    command = command_tuples[0][1]
-    arguments = argv[2:]
-    command(*arguments)
+    # report what the command did, e.g. the bytes moved by each copy method, away from any output written to stdout
+    if isinstance(result, dict):
+        for key in sorted(result):
+            stderr.write("{0}: {1}\n".format(key, result[key]))
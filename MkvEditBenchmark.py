@@ -0,0 +1,288 @@
+"""Contains functions to benchmark and check the matroska edit commands against synthetic files."""
+
+
+from contextlib import closing
+from inspect import getmembers, isfunction
+from json import dumps, loads
+from multiprocessing import Pool
+from os import remove
+from os.path import getsize, join
+from platform import python_version
+from random import Random
+from resource import getrusage, RUSAGE_SELF
+from shutil import copyfile, rmtree
+from sys import argv, modules, stderr, stdout
+from tempfile import mkdtemp
+
+
+from ebml.core import read_unicode_string, encode_element_id, encode_element_size, encode_string, encode_unicode_string, encode_unsigned_integer, MAXIMUM_ELEMENT_SIZE_LENGTH
+from ebml.schema.matroska import AttachmentsElement, AttachedFileElement, ClusterElement, ClusterTimecodeElement, CodecIDElement, DateUTCElement, DocTypeElement, DocTypeReadVersionElement, DocTypeVersionElement, EBMLElement, EBMLMaxIDLengthElement, EBMLMaxSizeLengthElement, EBMLReadVersionElement, EBMLVersionElement, FileDataElement, FileMimeTypeElement, FileNameElement, FileUIDElement, InfoElement, MuxingAppElement, SeekHeaderElement, SeekIDElement, SeekPointElement, SeekPositionElement, SegmentElement, SimpleBlockElement, TimecodeScaleElement, TracksElement, TrackEntryElement, TrackNumberElement, TrackTypeElement, TrackUIDElement, VoidElement, WritingAppElement
+
+import MkvEdit
+
+
+def generate_file(output_filename, size_mb = 256, clusters = 64, tracks = 2, attachments = 2, attachment_kb = 64, seed = 0, seekhead = 1):
+
+    size = int(size_mb) * 1024 * 1024
+    clusters = int(clusters)
+    tracks = int(tracks)
+    attachments = int(attachments)
+
+    # the same seed always produces the same file, so results from different commits stay comparable
+    random = Random(int(seed))
+    payload = bytearray(random.getrandbits(8) for _ in range(64 * 1024))
+
+    ebml_element = __encode_element(EBMLElement.id,
+        __encode_element(EBMLVersionElement.id, encode_unsigned_integer(1)) +
+        __encode_element(EBMLReadVersionElement.id, encode_unsigned_integer(1)) +
+        __encode_element(EBMLMaxIDLengthElement.id, encode_unsigned_integer(4)) +
+        __encode_element(EBMLMaxSizeLengthElement.id, encode_unsigned_integer(8)) +
+        __encode_element(DocTypeElement.id, encode_string("matroska")) +
+        __encode_element(DocTypeVersionElement.id, encode_unsigned_integer(4)) +
+        __encode_element(DocTypeReadVersionElement.id, encode_unsigned_integer(2)))
+
+    info_element = __encode_element(InfoElement.id,
+        __encode_element(TimecodeScaleElement.id, encode_unsigned_integer(1000000)) +
+        __encode_element(MuxingAppElement.id, encode_unicode_string(u"libebml v1.3.0 + libmatroska v1.4.0")) +
+        __encode_element(WritingAppElement.id, encode_unicode_string(u"mkvmerge v7.0.0")) +
+        __encode_element(DateUTCElement.id, bytearray(8)))
+
+    tracks_element = __encode_element(TracksElement.id, bytearray().join(
+        __encode_element(TrackEntryElement.id,
+            __encode_element(TrackNumberElement.id, encode_unsigned_integer(track_number)) +
+            __encode_element(TrackUIDElement.id, encode_unsigned_integer(random.getrandbits(63))) +
+            __encode_element(TrackTypeElement.id, encode_unsigned_integer(1 if track_number == 1 else 2)) +
+            __encode_element(CodecIDElement.id, encode_string("V_MPEG4/ISO/AVC" if track_number == 1 else "A_AAC")))
+        for track_number in range(1, tracks + 1)))
+
+    attachments_element = __encode_element(AttachmentsElement.id, bytearray().join(
+        __encode_element(AttachedFileElement.id,
+            __encode_element(FileNameElement.id, encode_unicode_string(u"attachment{0}.bin".format(attachment_number))) +
+            __encode_element(FileMimeTypeElement.id, encode_string("application/octet-stream")) +
+            __encode_element(FileDataElement.id, __repeat(payload, int(attachment_kb) * 1024)) +
+            __encode_element(FileUIDElement.id, encode_unsigned_integer(random.getrandbits(63))))
+        for attachment_number in range(1, attachments + 1))) if attachments else bytearray()
+
+    # lay the head out as mkvmerge does: a seekhead, some padding, then the elements it indexes
+    seekhead_size = len(__encode_seekhead_element(dict((element_id, 0) for element_id in (InfoElement.id, TracksElement.id, AttachmentsElement.id)[:3 if attachments else 2])))
+    void_element = __encode_element(VoidElement.id, bytearray(100))
+    head_elements = [(InfoElement.id, info_element), (TracksElement.id, tracks_element)] + ([(AttachmentsElement.id, attachments_element)] if attachments else [])
+
+    # without a seekhead the edits have to walk the top level elements to find what they change
+    if not int(seekhead):
+        seekhead_size = 0
+
+    seek_positions = {}
+    position = seekhead_size + len(void_element)
+    for element_id, element in head_elements:
+        seek_positions[element_id] = position
+        position += len(element)
+
+    segment_head = (__encode_seekhead_element(seek_positions) if seekhead_size else bytearray()) + void_element + bytearray().join(element for element_id, element in head_elements)
+
+    # share what is left between the clusters, each holding a single block of the payload
+    cluster_body_size = max(0, (size - len(ebml_element) - len(segment_head)) // max(1, clusters) - 32)
+    cluster_heads = []
+    segment_body_size = len(segment_head)
+
+    for cluster_number in range(clusters):
+        block_head = bytearray([0x81, 0x00, 0x00, 0x80])
+        cluster_head = __encode_element(ClusterTimecodeElement.id, encode_unsigned_integer(cluster_number * 1000)) + encode_element_id(SimpleBlockElement.id) + encode_element_size(len(block_head) + cluster_body_size) + block_head
+        cluster_head = encode_element_id(ClusterElement.id) + encode_element_size(len(cluster_head) + cluster_body_size) + cluster_head
+        cluster_heads.append(cluster_head)
+        segment_body_size += len(cluster_head) + cluster_body_size
+
+    # write the clusters piece-by-piece to avoid holding the whole file in memory
+    with open(output_filename, "wb") as output_file:
+        output_file.write(ebml_element + encode_element_id(SegmentElement.id) + encode_element_size(segment_body_size, MAXIMUM_ELEMENT_SIZE_LENGTH) + segment_head)
+
+        for cluster_head in cluster_heads:
+            output_file.write(cluster_head)
+
+            for offset in range(0, cluster_body_size, len(payload)):
+                output_file.write(payload[:cluster_body_size - offset])
+
+    return {"filename": output_filename, "size": getsize(output_filename), "clusters": clusters, "tracks": tracks, "attachments": attachments}
+
+
+def run_benchmark(results_filename = "-", **options):
+
+    repeat = int(options.pop("repeat", 3))
+    baseline_filename = options.pop("baseline", None)
+
+    # --copy-threads times the threaded copy in place of the sequential one
+    copy_threads = int(options.pop("copy_threads", 0))
+    parallel_copy = MkvEdit.ParallelCopy(copy_threads, int(float(options.pop("copy_chunk_size", 8)) * 1024 * 1024)) if copy_threads > 0 else None
+    directory = mkdtemp(prefix = "mkvedit-benchmark-")
+
+    try:
+        input_filename = join(directory, "input.mkv")
+        output_filename = join(directory, "output.mkv")
+        input_description = generate_file(input_filename, **options)
+
+        results = {"python": python_version(), "input": dict((key, value) for key, value in input_description.items() if key != "filename"), "repeat": repeat, "copy_threads": copy_threads, "commands": {}}
+
+        # time each command's phases separately, keeping the fastest of the repeated runs as the least disturbed
+        for command_name, edit_function, edit_arguments in __BENCHMARK_EDITS:
+            timings, peak_rss_bytes = __time_command_in_child(input_filename, output_filename, edit_function, edit_arguments, parallel_copy, repeat)
+            command_results = dict((phase, min(timing[phase] for timing in timings)) for phase in ("parse_seconds", "plan_seconds", "copy_seconds"))
+
+            total_seconds = sum(command_results.values())
+            command_results["total_seconds"] = total_seconds
+            command_results["megabytes_per_second"] = input_description["size"] / (1024.0 * 1024.0) / total_seconds if total_seconds else None
+            command_results["peak_rss_bytes"] = peak_rss_bytes
+            command_results["copy_statistics"] = timings[-1]["copy_statistics"]
+            results["commands"][command_name] = command_results
+
+            stderr.write("{0}: {1:.1f} MB/s (parse {2:.4f}s, plan {3:.4f}s, copy {4:.4f}s)\n".format(command_name, command_results["megabytes_per_second"] or 0, command_results["parse_seconds"], command_results["plan_seconds"], command_results["copy_seconds"]))
+
+    finally:
+        rmtree(directory)
+
+    # compare against the results saved from an earlier commit
+    if baseline_filename is not None:
+        with open(baseline_filename, "r") as baseline_file:
+            baseline = loads(baseline_file.read())
+
+        for command_name, command_results in sorted(results["commands"].items()):
+            if command_name in baseline["commands"] and baseline["commands"][command_name]["total_seconds"]:
+                change = command_results["total_seconds"] / baseline["commands"][command_name]["total_seconds"] - 1
+                stderr.write("{0}: {1:+.1%} time against baseline\n".format(command_name, change))
+
+    results_json = dumps(results, indent = 4, sort_keys = True)
+
+    if results_filename == "-":
+        stdout.write(results_json + "\n")
+
+    else:
+        with open(results_filename, "w") as results_file:
+            results_file.write(results_json + "\n")
+
+
+def check_in_place_edits(**options):
+
+    options.setdefault("size_mb", 4)
+    directory = mkdtemp(prefix = "mkvedit-check-")
+
+    try:
+        input_filename = join(directory, "input.mkv")
+        edited_filename = join(directory, "edited.mkv")
+        generate_file(input_filename, seekhead = 0, **options)
+
+        # each edit must see the ones before it, whether they were patched into the file or the file was then rewritten
+        for edits, expected_values in __IN_PLACE_CHECKS:
+            copyfile(input_filename, edited_filename)
+            MkvEdit.apply_edits(edited_filename, edited_filename, *edits)
+
+            values = __read_info_values(edited_filename)
+            if values != expected_values:
+                raise Exception("Check failed: {0} left {1} rather than {2}.".format(" ".join(edits), values, expected_values))
+
+    finally:
+        rmtree(directory)
+
+    return {"checks": len(__IN_PLACE_CHECKS)}
+
+
+def __read_info_values(filename):
+
+    with open(filename, "rb") as input_file, closing(MkvEdit.__map_file(input_file)) as input_view:
+        element_reader = MkvEdit.ElementReader(input_file, input_view, None, MkvEdit.EditProfile(), {})
+        segment_element_metadata = MkvEdit.__find_segment_element_metadata(element_reader)
+        info_element_metadata = MkvEdit.__find_top_level_element_metadata(element_reader, segment_element_metadata, InfoElement)
+
+        return dict((element.name, MkvEdit.__read_element_value(element_reader, MkvEdit.__find_element_metadata(element_reader, info_element_metadata, element), read_unicode_string)) for element in (MuxingAppElement, WritingAppElement))
+
+
+def __time_command_in_child(input_filename, output_filename, edit_function, edit_arguments, parallel_copy, repeat):
+
+    # a fresh process for each command keeps the peak memory it reports to that command, rather than the largest seen by the whole run
+    pool = Pool(1)
+
+    try:
+        return pool.apply(__time_command, (input_filename, output_filename, edit_function, edit_arguments, parallel_copy, repeat))
+
+    finally:
+        pool.close()
+        pool.join()
+
+
+def __time_command(input_filename, output_filename, edit_function, edit_arguments, parallel_copy, repeat):
+
+    timings = [__time_edit(input_filename, output_filename, edit_function, edit_arguments, parallel_copy) for _ in range(repeat)]
+
+    return timings, getrusage(RUSAGE_SELF).ru_maxrss * 1024
+
+
+def __time_edit(input_filename, output_filename, edit_function, edit_arguments, parallel_copy):
+
+    profile = MkvEdit.EditProfile()
+
+    with open(input_filename, "rb") as input_file, closing(MkvEdit.__map_file(input_file)) as input_view:
+        # locating the elements reads only their heads...
+        with profile.phase("parse"):
+            edits = [edit_function(MkvEdit.ElementReader(input_file, input_view, None, profile, {}), *edit_arguments)]
+
+        # ...planning works on the located elements alone...
+        with profile.phase("plan"):
+            MkvEdit.__plan_rewrite(MkvEdit.ElementReader(input_file, input_view, None, profile, {}), edits)
+
+        # ...and the copy moves the data, timed apart from the planning it does again for its own block alignment
+        rewrite_profile = MkvEdit.EditProfile()
+        with open(output_filename, "wb") as output_file:
+            copy_statistics = MkvEdit.__rewrite_file(MkvEdit.ElementReader(input_file, input_view, None, rewrite_profile, {}), output_file, edits, rewrite_profile, None, parallel_copy)
+
+    remove(output_filename)
+
+    return {"parse_seconds": profile.phases["parse"]["wall_seconds"], "plan_seconds": profile.phases["plan"]["wall_seconds"], "copy_seconds": rewrite_profile.phases["copy"]["wall_seconds"], "copy_statistics": copy_statistics}
+
+
+def __encode_element(element_id, body):
+
+    return encode_element_id(element_id) + encode_element_size(len(body)) + body
+
+
+def __encode_seekhead_element(seek_positions):
+
+    # eight byte positions keep the seekhead the same size whatever it points to
+    return __encode_element(SeekHeaderElement.id, bytearray().join(
+        __encode_element(SeekPointElement.id, __encode_element(SeekIDElement.id, encode_element_id(element_id)) + __encode_element(SeekPositionElement.id, encode_unsigned_integer(position, 8)))
+        for element_id, position in sorted(seek_positions.items(), key = lambda element_id_and_position: element_id_and_position[1])))
+
+
+def __repeat(data, size):
+
+    return (data * (size // len(data) + 1))[:size]
+
+
+__IN_PLACE_CHECKS = [
+    (["change_writingapp", "w", "change_muxingapp", "m"], {"MuxingApp": u"m", "WritingApp": u"w"}),
+    (["change_writingapp", "w", "change_muxingapp", "m" * 200], {"MuxingApp": u"m" * 200, "WritingApp": u"w"})]
+
+
+__BENCHMARK_EDITS = [
+    ("remove_dateutc", MkvEdit.__remove_dateutc_edit, ()),
+    ("change_muxingapp", MkvEdit.__change_muxingapp_edit, ("mkvedit benchmark muxer",)),
+    ("change_writingapp", MkvEdit.__change_writingapp_edit, ("mkvedit benchmark writer",)),
+    ("change_trackuid", MkvEdit.__change_trackuid_edit, ("1", "123456789")),
+    ("change_attachment_fileuid", MkvEdit.__change_attachment_fileuid_edit, ("attachment1.bin", "123456789"))]
+
+
+if __name__ == "__main__":
+
+    if len(argv) < 2:
+        raise Exception("Script expects at least a single argument representing the benchmark command.")
+
+    # invoke the requested command, passing any --name=value arguments as options
+    command_tuples = getmembers(modules[__name__], lambda member: isfunction(member) and member.__module__ == __name__ and member.__name__ == argv[1])
+
+    if len(command_tuples) == 0:
+        raise Exception("Cannot find command %s." % argv[1])
+
+    arguments = [argument for argument in argv[2:] if not argument.startswith("--")]
+    options = dict(MkvEdit.__parse_option(argument) for argument in argv[2:] if argument.startswith("--"))
+    result = command_tuples[0][1](*arguments, **options)
+
+    if isinstance(result, dict):
+        for key in sorted(result):
+            stderr.write("{0}: {1}\n".format(key, result[key]))